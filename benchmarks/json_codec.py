@@ -0,0 +1,208 @@
+"""
+Benchmark for ``marathon_acme.json_codec``.
+
+Decodes and encodes a Marathon-like ``/v2/apps`` response and a stream of
+``api_post_event`` events with each available JSON backend, and reports
+documents/s and MB/s. The ``/v2/apps`` response is also streamed through
+``JsonFieldItemsProtocol`` in chunks, as ``MarathonClient.get_apps()`` parses
+it when responses aren't cached. The protocol always decodes the items with
+the standard library, so the stream is only timed once.
+
+Usage: python benchmarks/json_codec.py [--apps N] [--events N] [--runs N]
+                                        [--chunk-size N]
+"""
+import argparse
+import json
+import time
+
+from twisted.python.failure import Failure
+from twisted.web.client import ResponseDone
+
+from marathon_acme import json_codec
+from marathon_acme.json_stream import JsonFieldItemsProtocol
+
+
+def make_app(index):
+    """
+    Build a Marathon app definition roughly the size of a real one, with
+    marathon-lb labels, a Docker container and health checks.
+    """
+    return {
+        'id': '/group-%d/app-%d' % (index % 10, index),
+        'cmd': None,
+        'args': ['--port', '8080', '--workers', '4'],
+        'user': None,
+        'env': dict(('ENV_VAR_%d' % (i,), 'value-%d' % (i,))
+                    for i in range(10)),
+        'instances': 2,
+        'cpus': 0.25,
+        'mem': 256.0,
+        'disk': 0.0,
+        'executor': '',
+        'constraints': [['hostname', 'UNIQUE']],
+        'uris': [],
+        'fetch': [],
+        'storeUrls': [],
+        'ports': [10000 + index],
+        'portDefinitions': [
+            {'port': 10000 + index, 'protocol': 'tcp', 'labels': {}},
+        ],
+        'requirePorts': False,
+        'backoffSeconds': 1,
+        'backoffFactor': 1.15,
+        'maxLaunchDelaySeconds': 3600,
+        'container': {
+            'type': 'DOCKER',
+            'volumes': [],
+            'docker': {
+                'image': 'example/app-%d:1.0.%d' % (index, index),
+                'network': 'BRIDGE',
+                'portMappings': [{
+                    'containerPort': 8080,
+                    'hostPort': 0,
+                    'servicePort': 10000 + index,
+                    'protocol': 'tcp',
+                    'labels': {},
+                }],
+                'privileged': False,
+                'parameters': [],
+                'forcePullImage': True,
+            },
+        },
+        'healthChecks': [{
+            'path': '/health',
+            'protocol': 'HTTP',
+            'portIndex': 0,
+            'gracePeriodSeconds': 300,
+            'intervalSeconds': 60,
+            'timeoutSeconds': 20,
+            'maxConsecutiveFailures': 3,
+            'ignoreHttp1xx': False,
+        }],
+        'readinessChecks': [],
+        'dependencies': [],
+        'upgradeStrategy': {
+            'minimumHealthCapacity': 1,
+            'maximumOverCapacity': 1,
+        },
+        'labels': {
+            'HAPROXY_GROUP': 'external',
+            'HAPROXY_0_VHOST': 'app-%d.example.com' % (index,),
+            'MARATHON_ACME_0_DOMAIN': 'app-%d.example.com' % (index,),
+        },
+        'acceptedResourceRoles': None,
+        'ipAddress': None,
+        'version': '2017-01-01T00:00:00.000Z',
+        'residency': None,
+        'secrets': {},
+        'taskKillGracePeriodSeconds': None,
+        'versionInfo': {
+            'lastScalingAt': '2017-01-01T00:00:00.000Z',
+            'lastConfigChangeAt': '2017-01-01T00:00:00.000Z',
+        },
+        'tasksStaged': 0,
+        'tasksRunning': 2,
+        'tasksHealthy': 2,
+        'tasksUnhealthy': 0,
+        'deployments': [],
+    }
+
+
+def make_apps_document(apps):
+    return json.dumps(
+        {'apps': [make_app(i) for i in range(apps)]}).encode('utf-8')
+
+
+def make_event_documents(events):
+    documents = []
+    for i in range(events):
+        documents.append(json.dumps({
+            'eventType': 'api_post_event',
+            'timestamp': '2017-01-01T00:00:00.000Z',
+            'clientIp': '10.0.0.1',
+            'uri': '/v2/apps/group-%d/app-%d' % (i % 10, i),
+            'appDefinition': make_app(i),
+        }))
+    return documents
+
+
+class _Transport(object):
+    def stopProducing(self):
+        pass
+
+
+def stream_apps(chunk_size):
+    """
+    Get a function that streams a ``/v2/apps`` document through
+    ``JsonFieldItemsProtocol`` a chunk at a time, like a response body.
+    """
+    def stream(document):
+        apps = []
+        protocol = JsonFieldItemsProtocol('apps', apps.append)
+        protocol.makeConnection(_Transport())
+        for i in range(0, len(document), chunk_size):
+            protocol.dataReceived(document[i:i + chunk_size])
+        protocol.connectionLost(Failure(ResponseDone()))
+        return apps
+    return stream
+
+
+def run(func, documents, runs):
+    """ Call the function with each document, returning the best time. """
+    best = None
+    for _ in range(runs):
+        start = time.time()
+        for document in documents:
+            func(document)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split(
+        '\n')[0])
+    parser.add_argument('--apps', type=int, default=1000)
+    parser.add_argument('--events', type=int, default=1000)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--chunk-size', type=int, default=64 * 1024)
+    args = parser.parse_args()
+
+    backends = [('json', json_codec._stdlib_loads, json_codec._stdlib_dumps)]
+    if json_codec.orjson is not None:
+        backends.append(
+            ('orjson', json_codec.orjson.loads, json_codec.orjson.dumps))
+    else:
+        print('orjson is not installed, only benchmarking json')
+
+    apps_document = make_apps_document(args.apps)
+    apps_obj = json.loads(apps_document.decode('utf-8'))
+    # Events are decoded from text, as SseProtocol passes them on
+    event_documents = make_event_documents(args.events)
+    event_objs = [json.loads(document) for document in event_documents]
+
+    payloads = [
+        ('/v2/apps', [apps_document], [apps_obj],
+         len(apps_document)),
+        ('api_post_event', event_documents, event_objs,
+         sum(len(document) for document in event_documents)),
+    ]
+
+    print('%-8s %-16s %-8s %12s %10s' % (
+        'backend', 'payload', 'op', 'docs/s', 'MB/s'))
+    for payload, documents, objs, size in payloads:
+        megabytes = size / (1024.0 * 1024.0)
+        for backend, loads, dumps in backends:
+            ops = [('loads', loads, documents), ('dumps', dumps, objs)]
+            if payload == '/v2/apps' and backend == 'json':
+                ops.append(('stream', stream_apps(args.chunk_size), documents))
+            for op, func, inputs in ops:
+                elapsed = run(func, inputs, args.runs)
+                print('%-8s %-16s %-8s %12.1f %10.2f' % (
+                    backend, payload, op, len(inputs) / elapsed,
+                    megabytes / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""
+Benchmark for ``marathon_acme.sse_protocol.SseProtocol``.
+
+Feeds a stream of Marathon-like ``api_post_event`` events through the
+protocol, both in large chunks and fragmented into small TCP-sized chunks, and
+reports events/s and MB/s. The previous ``splitlines()``-based implementation
+of ``dataReceived`` is included for comparison.
+
+Usage: python benchmarks/sse_protocol.py [--events N] [--app-size BYTES]
+"""
+import argparse
+import json
+import time
+
+from marathon_acme.sse_protocol import SseProtocol
+
+
+class LegacySseProtocol(SseProtocol):
+    """
+    The ``dataReceived`` implementation that rebuilt the buffer and re-split
+    it on every chunk, and decoded UTF-8 once per line.
+    """
+
+    def __init__(self, handler):
+        super(LegacySseProtocol, self).__init__(handler)
+        self._buffer = b''
+
+    def dataReceived(self, data):
+        lines = (self._buffer + data).splitlines()
+
+        if data.endswith(b'\n') or data.endswith(b'\r'):
+            self._buffer = b''
+        else:
+            self._buffer = lines.pop(-1)
+
+        for line in lines:
+            if len(line) > self.MAX_LENGTH:
+                self.lineLengthExceeded(line)
+                return
+            else:
+                self.lineReceived(line)
+        if len(self._buffer) > self.MAX_LENGTH:
+            self.lineLengthExceeded(self._buffer)
+            return
+
+    def lineReceived(self, line):
+        # Decode each line individually as the old implementation did
+        line.decode('utf-8')
+        super(LegacySseProtocol, self).lineReceived(line)
+
+
+class NullTransport(object):
+    disconnecting = False
+
+    def loseConnection(self):
+        self.disconnecting = True
+
+
+def make_stream(events, app_size):
+    """
+    Build an SSE stream of ``api_post_event`` events, each carrying an app
+    definition with roughly ``app_size`` bytes of labels.
+    """
+    labels = {}
+    index = 0
+    while len(json.dumps(labels)) < app_size:
+        labels['LABEL_%d' % (index,)] = 'x' * 64
+        index += 1
+
+    parts = []
+    for i in range(events):
+        event = {
+            'eventType': 'api_post_event',
+            'timestamp': '2017-01-01T00:00:00.000Z',
+            'uri': '/v2/apps/app-%d' % (i,),
+            'appDefinition': {'id': '/app-%d' % (i,), 'labels': labels},
+        }
+        parts.append(b'event: api_post_event\r\n')
+        parts.append(b'data: ' + json.dumps(event).encode('utf-8') + b'\r\n')
+        parts.append(b'\r\n')
+    return b''.join(parts)
+
+
+def chunked(stream, chunk_size):
+    return [stream[i:i + chunk_size]
+            for i in range(0, len(stream), chunk_size)]
+
+
+def run(protocol_class, chunks, expected_events):
+    received = []
+    protocol = protocol_class(lambda event, data: received.append(event))
+    protocol.transport = NullTransport()
+
+    start = time.time()
+    for chunk in chunks:
+        protocol.dataReceived(chunk)
+    elapsed = time.time() - start
+
+    assert len(received) == expected_events
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split(
+        '\n')[0])
+    parser.add_argument('--events', type=int, default=200)
+    parser.add_argument('--app-size', type=int, default=64 * 1024)
+    args = parser.parse_args()
+
+    stream = make_stream(args.events, args.app_size)
+    megabytes = len(stream) / (1024.0 * 1024.0)
+
+    print('%d events, %.2f MB total' % (args.events, megabytes))
+    print('%-12s %-14s %12s %10s' % ('impl', 'chunking', 'events/s', 'MB/s'))
+    for name, chunk_size in [('unfragmented', 64 * 1024),
+                             ('fragmented', 1460)]:
+        chunks = chunked(stream, chunk_size)
+        for impl, protocol_class in [('legacy', LegacySseProtocol),
+                                     ('current', SseProtocol)]:
+            elapsed = run(protocol_class, chunks, args.events)
+            print('%-12s %-14s %12.1f %10.2f' % (
+                impl, name, args.events / elapsed, megabytes / elapsed))
+
+
+if __name__ == '__main__':
+    main()
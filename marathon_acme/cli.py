@@ -14,7 +14,9 @@ from txacme.store import DirectoryStore
 
 from marathon_acme.acme_util import (
     create_txacme_client_creator, generate_wildcard_pem_bytes, maybe_key)
-from marathon_acme.clients import MarathonClient, MarathonLbClient
+from marathon_acme.clients import (
+    CountingHTTPConnectionPool, MarathonClient, MarathonLbClient)
+from marathon_acme.resolver import CachingHostnameResolver
 from marathon_acme.service import MarathonAcme
 
 
@@ -42,6 +44,56 @@ parser.add_argument('-g', '--group',
                     help='The marathon-lb group to issue certificates for '
                          '(default: %(default)s)',
                     default='external')
+parser.add_argument('--marathon-label', metavar='KEY[==VALUE]',
+                    help='Only issue certificates for Marathon apps with '
+                         'this label, or with this label set to this value '
+                         '(optional)')
+parser.add_argument('--marathon-group',
+                    help='Only issue certificates for Marathon apps in this '
+                         'Marathon group, e.g. /my-group (optional)')
+parser.add_argument('--event-stream-timeout',
+                    help='The number of seconds that the Marathon event '
+                         'stream may be idle before it is reconnected, or 0 '
+                         'to never time out (default: %(default)s)',
+                    type=int, default=300)
+parser.add_argument('--sync-delay',
+                    help='The number of seconds to wait after a Marathon '
+                         'event before syncing, so that events received close '
+                         'together trigger a single sync (default: '
+                         '%(default)s)',
+                    type=float, default=1.0)
+parser.add_argument('--marathon-cache-ttl',
+                    help='Cache the list of Marathon apps and reuse it for '
+                         'this many seconds, revalidating it with Marathon '
+                         'after that (optional)',
+                    type=float)
+parser.add_argument('--marathon-hedge',
+                    help='If a Marathon endpoint is slow to respond to a GET '
+                         'request, also make the request to the next '
+                         'endpoint and use the first response',
+                    action='store_true')
+parser.add_argument('--marathon-adaptive-timeouts',
+                    help='Time out requests to a Marathon endpoint sooner if '
+                         'it usually responds quickly, based on its recent '
+                         'response times',
+                    action='store_true')
+parser.add_argument('--marathon-event-streams',
+                    help='The number of Marathon endpoints to listen for '
+                         'events from at once, so that losing one endpoint '
+                         'does not interrupt the events (default: '
+                         '%(default)s)',
+                    type=int, default=1)
+parser.add_argument('--dns-cache-ttl',
+                    help='Cache the addresses of hostnames such as '
+                         'marathon.mesos and reuse them for this many seconds '
+                         'before resolving the hostnames again (optional)',
+                    type=float)
+parser.add_argument('--dns-max-stale',
+                    help='With --dns-cache-ttl, the number of seconds after '
+                         'cached addresses expire that they may still be used '
+                         'if the hostname cannot be resolved (default: '
+                         '%(default)s)',
+                    type=float, default=300.0)
 parser.add_argument('--listen',
                     help='The address for the port to listen on (default: '
                          '%(default)s)',
@@ -72,7 +124,14 @@ def main(reactor, raw_args=sys.argv[1:]):
     marathon_acme = create_marathon_acme(
         args.storage_dir, args.acme, args.email,
         marathon_addrs, mlb_addrs, args.group,
-        reactor)
+        reactor, event_stream_timeout=args.event_stream_timeout or None,
+        sync_delay=args.sync_delay, app_label=args.marathon_label,
+        app_group=args.marathon_group,
+        marathon_cache_ttl=args.marathon_cache_ttl,
+        marathon_hedge=args.marathon_hedge,
+        marathon_adaptive_timeouts=args.marathon_adaptive_timeouts,
+        marathon_event_streams=args.marathon_event_streams,
+        dns_cache_ttl=args.dns_cache_ttl, dns_max_stale=args.dns_max_stale)
 
     # Run the thing
     endpoint_description = parse_listen_addr(args.listen)
@@ -137,7 +196,12 @@ def _create_tx_endpoints_string(args, kwargs):
 
 def create_marathon_acme(storage_dir, acme_directory, acme_email,
                          marathon_addrs, mlb_addrs, group,
-                         reactor):
+                         reactor, event_stream_timeout=None, sync_delay=0,
+                         app_label=None, app_group=None,
+                         marathon_cache_ttl=None, marathon_hedge=False,
+                         marathon_adaptive_timeouts=False,
+                         marathon_event_streams=1, dns_cache_ttl=None,
+                         dns_max_stale=300):
     """
     Create a marathon-acme instance.
 
@@ -156,19 +220,67 @@ def create_marathon_acme(storage_dir, acme_directory, acme_email,
         The marathon-lb group (``HAPROXY_GROUP``) to consider when finding
         app domains.
     :param reactor: The reactor to use.
+    :param event_stream_timeout:
+        The number of seconds that the Marathon event stream may be idle before
+        it is reconnected.
+    :param sync_delay:
+        The number of seconds to wait after a Marathon event before syncing.
+    :param app_label:
+        Only issue certificates for Marathon apps with a label matching this
+        label selector (``KEY`` or ``KEY==VALUE``).
+    :param app_group:
+        Only issue certificates for Marathon apps in this Marathon group.
+    :param marathon_cache_ttl:
+        The number of seconds to reuse a cached list of Marathon apps for, or
+        None to not cache the list.
+    :param marathon_hedge:
+        Whether to hedge GET requests to Marathon across its endpoints.
+    :param marathon_adaptive_timeouts:
+        Whether to adapt the timeouts for requests to each Marathon endpoint to
+        the endpoint's response times.
+    :param marathon_event_streams:
+        The number of Marathon endpoints to attach to the event stream of at
+        once.
+    :param dns_cache_ttl:
+        The number of seconds to cache the addresses of resolved hostnames
+        for, or None to not cache them. The caching resolver is installed on
+        the reactor, so it is used for every outgoing connection.
+    :param dns_max_stale:
+        The number of seconds after cached addresses expire that they may still
+        be used if the hostname can't be resolved.
     """
     storage_path, certs_path = init_storage_dir(storage_dir)
     acme_url = URL.fromText(_to_unicode(acme_directory))
     key = maybe_key(storage_path)
 
+    # Share persistent connections between the Marathon and marathon-lb
+    # clients so that each request doesn't pay for a new connection
+    pool = CountingHTTPConnectionPool(reactor)
+
+    name_resolver = None
+    if dns_cache_ttl is not None:
+        name_resolver = CachingHostnameResolver(
+            reactor.nameResolver, reactor, ttl=dns_cache_ttl,
+            max_stale=dns_max_stale)
+        reactor.installNameResolver(name_resolver)
+
     return MarathonAcme(
-        MarathonClient(marathon_addrs, reactor=reactor),
+        MarathonClient(marathon_addrs, reactor=reactor, pool=pool,
+                       cache_ttl=marathon_cache_ttl, hedge=marathon_hedge,
+                       adaptive_timeouts=marathon_adaptive_timeouts,
+                       event_streams=marathon_event_streams),
         group,
         DirectoryStore(certs_path),
-        MarathonLbClient(mlb_addrs, reactor=reactor),
+        MarathonLbClient(mlb_addrs, reactor=reactor, pool=pool),
         create_txacme_client_creator(reactor, acme_url, key),
         reactor,
-        acme_email)
+        acme_email,
+        event_stream_timeout=event_stream_timeout,
+        sync_delay=sync_delay,
+        app_label=app_label,
+        app_group=app_group,
+        connection_pool=pool,
+        name_resolver=name_resolver)
 
 
 def init_storage_dir(storage_dir):
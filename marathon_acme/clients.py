@@ -1,13 +1,24 @@
 import cgi
+import hashlib
 import json
+import random
+from collections import deque
 
 from requests.exceptions import HTTPError
 from treq.client import HTTPClient as treq_HTTPClient
-from twisted.internet.defer import DeferredList
+from twisted.internet.defer import (
+    Deferred, DeferredList, DeferredLock, fail, maybeDeferred, succeed)
+from twisted.internet.error import ConnectionAborted, TimeoutError
+from twisted.internet.protocol import connectionDone, Protocol
+from twisted.protocols.policies import TimeoutMixin
 from twisted.logger import Logger, LogLevel
-from twisted.web.http import OK
+from twisted.python.failure import Failure
+from twisted.web.client import HTTPConnectionPool, ResponseDone
+from twisted.web.http import NOT_MODIFIED, OK, PotentialDataLoss
 from uritools import uricompose, uridecode, urisplit
 
+from marathon_acme import json_codec
+from marathon_acme.json_stream import JsonFieldItemsProtocol
 from marathon_acme.sse_protocol import SseProtocol
 
 
@@ -29,15 +40,157 @@ def get_single_header(headers, key):
     return header
 
 
-def json_content(response):
+class _BodyTimeoutProtocol(Protocol, TimeoutMixin):
+    """
+    A protocol that passes the body of a response on to another protocol,
+    stopping the transfer of the body if no data is received for ``timeout``
+    seconds.
+    """
+
+    def __init__(self, protocol, timeout, reactor):
+        self._protocol = protocol
+        self._timeout = timeout
+        self._timed_out = False
+        self.callLater = reactor.callLater
+
+    def makeConnection(self, transport):
+        Protocol.makeConnection(self, transport)
+        self._protocol.makeConnection(transport)
+
+    def connectionMade(self):
+        self.setTimeout(self._timeout)
+
+    def timeoutConnection(self):
+        self._timed_out = True
+        self.transport.stopProducing()
+
+    def dataReceived(self, data):
+        self.resetTimeout()
+        self._protocol.dataReceived(data)
+
+    def connectionLost(self, reason=connectionDone):
+        self.setTimeout(None)
+        if self._timed_out:
+            reason = Failure(TimeoutError(
+                'No response body received for %s seconds' % (
+                    self._timeout,)))
+        self._protocol.connectionLost(reason)
+
+
+class _BodyCollector(Protocol):
+    def __init__(self, finished):
+        self._finished = finished
+        self._data = []
+
+    def dataReceived(self, data):
+        self._data.append(data)
+
+    def connectionLost(self, reason=connectionDone):
+        if reason.check(ResponseDone, PotentialDataLoss):
+            self._finished.callback(b''.join(self._data))
+        else:
+            self._finished.errback(reason)
+
+
+def deliver_body(response, protocol, timeout=None, reactor=None):
+    """
+    Deliver the body of a response to a protocol.
+
+    :param timeout:
+        The number of seconds that the body may be idle before the transfer
+        is stopped and the protocol's connection is lost with a
+        ``TimeoutError``. If None, the body may be idle indefinitely.
+    :param reactor: The reactor to use for the timeout.
+    """
+    if timeout is not None:
+        protocol = _BodyTimeoutProtocol(
+            protocol, timeout, default_reactor(reactor))
+    response.deliverBody(protocol)
+
+
+def read_body(response, timeout=None, reactor=None):
+    """
+    Read the body of a response.
+
+    :param timeout:
+        The number of seconds that the body may be idle before the read
+        fails with a ``TimeoutError``. If None, the body may be idle
+        indefinitely.
+    :param reactor: The reactor to use for the timeout.
+    :return: A deferred that fires with the body as bytes.
+    """
+    finished = Deferred()
+    deliver_body(response, _BodyCollector(finished), timeout, reactor)
+    return finished
+
+
+def json_content(response, timeout=None, reactor=None):
+    """
+    Callback to read and parse the JSON content of a response.
+
+    :param timeout:
+        The number of seconds that the response body may be idle while it is
+        read, or None.
+    :param reactor: The reactor to use for the timeout.
+    """
     # Raise if content type is not application/json
     raise_for_header(response, 'Content-Type', 'application/json')
 
-    # Workaround for treq not treating JSON as UTF-8 by default (RFC7158)
-    # https://github.com/twisted/treq/pull/126
+    # JSON is always UTF-8 (RFC7158), whatever the Content-Type says
     # See this discussion: http://stackoverflow.com/q/9254891
-    d = response.text(encoding='utf-8')
-    return d.addCallback(json.loads)
+    d = read_body(response, timeout, reactor)
+    return d.addCallback(json_codec.loads)
+
+
+def json_field_items(response, field, handler, timeout=None, reactor=None):
+    """
+    Callback to incrementally parse the JSON content of a response, calling
+    the handler with each item of the array in the given field of the JSON
+    object as soon as that item has been received.
+
+    :param timeout:
+        The number of seconds that the response body may be idle while it is
+        read, or None.
+    :param reactor: The reactor to use for the timeout.
+    :return: A deferred that fires with None once the content is parsed.
+    """
+    raise_for_header(response, 'Content-Type', 'application/json')
+
+    protocol = JsonFieldItemsProtocol(field, handler)
+    finished = protocol.when_finished()
+    deliver_body(response, protocol, timeout, reactor)
+    return finished
+
+
+class _FedBodyTransport(object):
+    stopped = False
+
+    def stopProducing(self):
+        self.stopped = True
+
+
+def feed_body(body, protocol, reactor, chunk_size):
+    """
+    Deliver a body that has already been received to a protocol a chunk at a
+    time, returning to the reactor between chunks so that the reactor isn't
+    blocked for as long as the protocol takes to process the whole body.
+
+    :param body: The body as bytes.
+    :param reactor: The reactor to use to schedule each chunk.
+    :param chunk_size: The number of bytes to deliver in each chunk.
+    """
+    transport = _FedBodyTransport()
+    protocol.makeConnection(transport)
+
+    def feed(offset):
+        if transport.stopped:
+            protocol.connectionLost(Failure(ConnectionAborted()))
+        elif offset >= len(body):
+            protocol.connectionLost(Failure(ResponseDone()))
+        else:
+            protocol.dataReceived(body[offset:offset + chunk_size])
+            reactor.callLater(0, feed, offset + chunk_size)
+    feed(0)
 
 
 def raise_for_status(response):
@@ -81,31 +234,108 @@ def default_reactor(reactor):
     return reactor
 
 
-def default_client(client, reactor):
+def default_client(client, reactor, pool=None, connect_timeout=None):
     """
     Set up a default client if one is not provided. Set up the default
-    ``twisted.web.client.Agent`` using the provided reactor.
+    ``twisted.web.client.Agent`` using the provided reactor, connection pool
+    and connect timeout.
+
+    treq asks for gzip-compressed content with every request and decompresses
+    response bodies as they are delivered, so compressed responses can still
+    be streamed.
     """
     if client is None:
         from twisted.web.client import Agent
-        client = treq_HTTPClient(Agent(reactor))
+        client = treq_HTTPClient(
+            Agent(reactor, connectTimeout=connect_timeout, pool=pool))
 
     return client
 
 
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    """
+    A pool of persistent HTTP connections that counts how many connections
+    have been opened and how many requests have reused a pooled connection
+    instead.
+    """
+
+    def __init__(self, reactor, max_per_host=2, idle_timeout=240):
+        """
+        :param reactor: The reactor to use.
+        :param max_per_host:
+            The maximum number of idle connections to keep open to each host.
+        :param idle_timeout:
+            The number of seconds that an idle connection is kept open for.
+        """
+        super(CountingHTTPConnectionPool, self).__init__(
+            reactor, persistent=True)
+        self.maxPersistentPerHost = max_per_host
+        self.cachedConnectionTimeout = idle_timeout
+
+        self.requests = 0
+        self.connections = 0
+
+    @property
+    def reused(self):
+        """ The number of requests that reused a pooled connection. """
+        return self.requests - self.connections
+
+    def getConnection(self, key, endpoint):
+        self.requests += 1
+        return super(CountingHTTPConnectionPool, self).getConnection(
+            key, endpoint)
+
+    def _newConnection(self, key, endpoint):
+        self.connections += 1
+        return super(CountingHTTPConnectionPool, self)._newConnection(
+            key, endpoint)
+
+
+class TimeoutPolicy(object):
+    """
+    The timeouts for an operation performed by a client.
+    """
+
+    def __init__(self, first_byte, body):
+        """
+        :param first_byte:
+            The number of seconds to wait for the response headers once the
+            request has been made, or None to wait indefinitely.
+        :param body:
+            The number of seconds that the response body may be idle while it
+            is read, or None for no limit.
+        """
+        self.first_byte = first_byte
+        self.body = body
+
+
 class HTTPClient(object):
+    # The default number of seconds to wait to connect, for the response
+    # headers, and between chunks of the response body
+    connect_timeout = 5
     timeout = 5
+    body_timeout = 5
+    # Timeout policies for particular operations, by operation name
+    timeout_policies = {}
+
     log = Logger()
 
-    def __init__(self, url=None, client=None, reactor=None):
+    def __init__(self, url=None, client=None, reactor=None, pool=None):
         """
         Create a client with the specified default URL.
+
+        :param pool:
+            The ``HTTPConnectionPool`` for the default client to use, so that
+            connections can be shared between clients. If None, connections
+            are not persistent.
         """
         self.url = url
         # Keep track of the reactor because treq uses it for timeouts in a
         # clumsy way
         self._reactor = default_reactor(reactor)
-        self._client = default_client(client, self._reactor)
+        self._client = default_client(
+            client, self._reactor, pool, self.connect_timeout)
+        self._abandoned = set()
 
     def _log_request_response(self, response, method, path, kwargs):
         self.log.debug(
@@ -113,11 +343,37 @@ class HTTPClient(object):
             method=method, path=path, args=kwargs, code=response.code)
         return response
 
-    def _log_request_error(self, failure, url):
+    def _log_request_error(self, failure, url, d=None):
+        if d in self._abandoned:
+            self.log.debug('Abandoned request to url "{url}"', url=url)
+            return failure
+
         self.log.failure('Error performing request to url "{url}"', failure,
                          LogLevel.error, url=url)
         return failure
 
+    def timeout_policy(self, operation=None):
+        """
+        Get the timeout policy for an operation. Operations without a policy
+        of their own use the client's default timeouts.
+        """
+        policy = self.timeout_policies.get(operation)
+        if policy is None:
+            policy = TimeoutPolicy(self.timeout, self.body_timeout)
+        return policy
+
+    def abandon(self, d):
+        """
+        Cancel a request made with ``request()`` whose response is no longer
+        needed, without logging an error for it.
+
+        :param d: The deferred returned by ``request()``.
+        """
+        # Cancelling the request fails it straight away
+        self._abandoned.add(d)
+        d.cancel()
+        self._abandoned.discard(d)
+
     def _compose_url(self, url, kwargs):
         """
         Compose a URL starting with the given URL (or self.url if that URL is
@@ -166,19 +422,24 @@ class HTTPClient(object):
         :param: url:
             The URL to use. The default value is the URL this client was
             created with (`self.url`) (example is `http://localhost:8080`)
+        :param: operation:
+            The name of the operation that the request is for, which sets the
+            default timeout for the response headers. See
+            ``timeout_policy()``.
         :param: kwargs:
             Any other parameters that will be passed to `treq.request`, for
             example headers. Or any URL parameters to override, for example
             path, query or fragment.
         """
+        operation = kwargs.pop('operation', None)
         url = self._compose_url(url, kwargs)
 
-        kwargs.setdefault('timeout', self.timeout)
+        kwargs.setdefault('timeout', self.timeout_policy(operation).first_byte)
 
         d = self._client.request(method, url, reactor=self._reactor, **kwargs)
 
         d.addCallback(self._log_request_response, method, url, kwargs)
-        d.addErrback(self._log_request_error, url)
+        d.addErrback(self._log_request_error, url, d)
 
         return d
 
@@ -193,7 +454,7 @@ class JsonClient(HTTPClient):
 
         :param: json_data:
             A python data structure that will be converted to a JSON string
-            using `json.dumps` and used as the request body.
+            using `json_codec.dumps` and used as the request body.
         """
         data = kwargs.get('data')
         headers = kwargs.get('headers', {}).copy()
@@ -205,7 +466,7 @@ class JsonClient(HTTPClient):
                 raise ValueError("Cannot specify both 'data' and 'json_data' "
                                  'keyword arguments')
 
-            data = json.dumps(json_data).encode('utf-8')
+            data = json_codec.dumps(json_data)
             headers.setdefault('Content-Type', 'application/json')
 
         kwargs['headers'] = headers
@@ -226,12 +487,12 @@ def raise_for_not_ok_status(response):
     return response
 
 
-def _sse_content_with_protocol(response, handler):
+def _sse_content_with_protocol(response, handler, **sse_kwargs):
     """
     Sometimes we need the protocol object so that we can manipulate the
     underlying transport in tests.
     """
-    protocol = SseProtocol(handler)
+    protocol = SseProtocol(handler, **sse_kwargs)
     finished = protocol.when_finished()
 
     response.deliverBody(protocol)
@@ -239,7 +500,7 @@ def _sse_content_with_protocol(response, handler):
     return finished, protocol
 
 
-def sse_content(response, handler):
+def sse_content(response, handler, **sse_kwargs):
     """
     Callback to collect the Server-Sent Events content of a response. Callbacks
     passed will receive event data.
@@ -248,16 +509,184 @@ def sse_content(response, handler):
         The response from the SSE request.
     :param handler:
         The handler for the SSE protocol.
+    :param sse_kwargs:
+        Any other keyword arguments to pass to the ``SseProtocol``.
+    :return:
+        A deferred that fires with the ``SseProtocol`` when the connection is
+        closed, so that the final state of the stream can be inspected.
     """
     # An SSE response must be 200/OK and have content-type 'text/event-stream'
     raise_for_not_ok_status(response)
     raise_for_header(response, 'Content-Type', 'text/event-stream')
 
-    finished, _ = _sse_content_with_protocol(response, handler)
-    return finished
+    finished, protocol = _sse_content_with_protocol(
+        response, handler, **sse_kwargs)
+    return finished.addCallback(lambda _: protocol)
+
+
+def label_matches(label, labels):
+    """
+    Check whether a set of Marathon labels matches a label selector of the
+    form ``KEY`` or ``KEY==VALUE``.
+    """
+    key, sep, value = label.partition('==')
+    if key not in labels:
+        return False
+    return not sep or labels[key] == value
+
+
+def backoff_delay(attempts, base, maximum):
+    """
+    Get the delay in seconds before reconnecting after a number of attempts
+    since the connection was last healthy. The first attempt is immediate,
+    after that the delay backs off exponentially from the base delay up to
+    the maximum delay, with jitter.
+    """
+    if attempts == 0:
+        return 0
+    delay = min(maximum, base * 2 ** (attempts - 1))
+    # "Equal jitter": wait at least half the delay
+    return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+
+class _CachedResponse(object):
+    """
+    The parsed content of the most recent response to a cached request, with
+    what is needed to check whether it is still current.
+    """
+
+    def __init__(self, content, fetched_at, digest, etag, last_modified):
+        self.content = content
+        self.fetched_at = fetched_at
+        self.digest = digest
+        self.etag = etag
+        self.last_modified = last_modified
+
+
+class CircuitBreaker(object):
+    """
+    Tracks the health of an endpoint from the results of the requests made
+    to it. After ``failure_threshold`` consecutive failures the circuit
+    opens and requests to the endpoint are skipped. Once ``cooldown``
+    seconds have passed, the circuit is half-open and a single request is
+    allowed through to probe the endpoint: if it succeeds the circuit
+    closes, otherwise it opens again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, clock, failure_threshold, cooldown):
+        self._clock = clock
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+
+        self._state = self.CLOSED
+        self._opened_at = None
+        self._probing = False
+        self.failures = 0
+        self.total_failures = 0
+
+    @property
+    def state(self):
+        if (self._state == self.OPEN and
+                self._clock.seconds() - self._opened_at >= self.cooldown):
+            self._state = self.HALF_OPEN
+        return self._state
+
+    @property
+    def cooldown_ends(self):
+        """
+        The time at which the circuit is (or was) due to be half-open, or
+        None if the circuit is closed.
+        """
+        if self._state == self.CLOSED:
+            return None
+        return self._opened_at + self.cooldown
+
+    def allow_request(self):
+        """
+        Check whether a request may be made to the endpoint. If the circuit
+        is half-open, this reserves the single probe request.
+        """
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def force_probe(self):
+        """
+        Reserve a probe request even though the circuit is open or another
+        probe is in flight, for when there is no other endpoint to try.
+        """
+        self._probing = True
+
+    def record_abandoned(self):
+        """
+        Record that a request that was allowed was abandoned before it
+        finished, so that it doesn't count as the probe request.
+        """
+        self._probing = False
+
+    def record_success(self):
+        self._state = self.CLOSED
+        self._probing = False
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        self.total_failures += 1
+        if (self._probing or self._state == self.HALF_OPEN or
+                self.failures >= self.failure_threshold):
+            self._state = self.OPEN
+            self._opened_at = self._clock.seconds()
+        self._probing = False
 
 
 class MarathonClient(JsonClient):
+    # The number of consecutive failed requests to an endpoint before it is
+    # skipped, and the number of seconds before it is tried again
+    failure_threshold = 3
+    failure_cooldown = 30
+    # The number of response times to keep for each endpoint and operation,
+    # and the number needed before they are used for hedging and adaptive
+    # timeouts
+    response_time_samples = 100
+    response_time_min_samples = 20
+    # When hedging, the number of seconds to wait for an endpoint before
+    # trying the next one, until enough response times have been observed to
+    # wait for the endpoint's 95th percentile response time instead
+    hedge_delay = 1
+    # With adaptive timeouts, the response header timeout for an endpoint is
+    # this multiple of its 99th percentile response time, within the bounds of
+    # the minimum and the operation's timeout
+    adaptive_timeout_factor = 4
+    adaptive_timeout_min = 1
+    # Cached lists of apps at least this many bytes long are decoded a chunk
+    # at a time, so that the reactor can serve health checks and ACME
+    # challenges while a big list is decoded
+    cooperative_decode_size = 1024 * 1024
+    cooperative_decode_chunk_size = 64 * 1024
+    # When attached to several event streams, the number of recent events
+    # to remember so that copies arriving on the other streams are dropped
+    event_dedup_window = 1000
+    # While attached to the other event streams, reattaches to a lost stream
+    # back off exponentially from the base delay up to the maximum delay (in
+    # seconds). The backoff is reset once the stream has stayed attached for
+    # the reset time.
+    event_reattach_delay_base = 1
+    event_reattach_delay_max = 60
+    event_reattach_reset_time = 60
+
+    timeout_policies = {
+        # Large lists of apps can take a while for Marathon to build and send
+        'apps': TimeoutPolicy(first_byte=30, body=15),
+        # The event stream has its own idle timeout
+        'events': TimeoutPolicy(first_byte=5, body=None),
+    }
 
     def __init__(self, endpoints, *args, **kwargs):
         """
@@ -265,31 +694,324 @@ class MarathonClient(JsonClient):
             A priority-ordered list of Marathon endpoints. Each endpoint will
             be tried one-by-one until the request succeeds or all endpoints
             fail.
+        :param cache_ttl:
+            If provided, the responses to requests for lists of apps are
+            cached. Any requests made while a request is in flight share its
+            response, the cached response is reused for this many seconds,
+            and after that the request is made conditionally so that an
+            unchanged response is not parsed again. If None, responses are
+            not cached and apps are parsed incrementally as they are
+            received.
+        :param hedge:
+            Whether to hedge GET requests: if an endpoint hasn't responded
+            within its 95th percentile response time, the request is also made
+            to the next endpoint. The first response is used and the other
+            requests are cancelled.
+        :param adaptive_timeouts:
+            Whether to shorten the response header timeout for each endpoint
+            to fit the response times observed for it, so that an endpoint that
+            stops responding is given up on sooner.
+        :param event_streams:
+            The number of endpoints to attach to the event stream of at once.
+            Each event is handled once, whichever stream it arrives on first,
+            so that the loss of one endpoint doesn't interrupt the events. A
+            lost stream is reattached to with backoff while the others are
+            attached.
         """
+        self.cache_ttl = kwargs.pop('cache_ttl', None)
+        self.hedge = kwargs.pop('hedge', False)
+        self.adaptive_timeouts = kwargs.pop('adaptive_timeouts', False)
+        self.event_streams = kwargs.pop('event_streams', 1)
         super(MarathonClient, self).__init__(*args, **kwargs)
         self.endpoints = endpoints
 
-    def request(self, *args, **kwargs):
-        d = self._request(None, list(self.endpoints), *args, **kwargs)
+        self._cache = {}
+        self._in_flight = {}
+
+        self._leader_endpoint = None
+        self._last_endpoint = None
+        self._breakers = {}
+        self._response_times = {}
+
+        self.duplicate_events = 0
+
+    def request(self, method, *args, **kwargs):
+        """
+        Perform a request to the Marathon endpoints.
+
+        :param hedge:
+            Whether to hedge the request. Defaults to hedging GET requests if
+            the client was created with ``hedge=True``.
+        """
+        hedge = kwargs.pop('hedge', self.hedge and method == 'GET')
+        endpoints = self._endpoint_order()
+        if hedge and len(endpoints) > 1:
+            d = self._hedged_request(endpoints, method, *args, **kwargs)
+        else:
+            d = self._request(None, endpoints, method, *args, **kwargs)
         d.addErrback(self._log_all_endpoints_failed)
         return d
 
+    def _endpoint_order(self):
+        """
+        Get the endpoints in the order that they should be tried: the leader
+        (if known), then the endpoint that last succeeded, and then the rest
+        in priority order.
+        """
+        endpoints = list(self.endpoints)
+        for endpoint in [self._last_endpoint, self._leader_endpoint]:
+            if endpoint in endpoints:
+                endpoints.remove(endpoint)
+                endpoints.insert(0, endpoint)
+        return endpoints
+
     def _request(self, failure, endpoints, *args, **kwargs):
         """
         Recursively make requests to each endpoint in ``endpoints``.
         """
-        # We've run out of endpoints, fail
+        # Skip the endpoints that have failed repeatedly
+        skipped = []
+        while endpoints and not self._breaker(endpoints[0]).allow_request():
+            skipped.append(endpoints.pop(0))
+            self.log.debug('Skipping failing Marathon endpoint {endpoint}',
+                           endpoint=skipped[-1])
+
         if not endpoints:
-            return failure
+            # We've run out of endpoints, fail
+            if failure is not None:
+                return failure
+            if not skipped:
+                return fail(RuntimeError(
+                    'No Marathon endpoints, not making request'))
+            # Every endpoint is failing but nothing has been tried yet
+            endpoints = [self._probe_endpoint(skipped)]
 
         endpoint = endpoints.pop(0)
-        d = super(MarathonClient, self).request(*args, url=endpoint, **kwargs)
+        d = self._endpoint_request(endpoint, *args, **kwargs)
+        d.addCallbacks(self._endpoint_succeeded, self._endpoint_failed,
+                       callbackArgs=[endpoint, kwargs.get('operation'),
+                                     self._reactor.seconds()],
+                       errbackArgs=[endpoint])
 
         # If something goes wrong, call ourselves again with the remaining
         # endpoints
         d.addErrback(self._request, endpoints, *args, **kwargs)
         return d
 
+    def _endpoint_request(self, endpoint, *args, **kwargs):
+        """
+        Make a request to a single endpoint, with an adaptive timeout if
+        enabled.
+        """
+        if self.adaptive_timeouts and 'timeout' not in kwargs:
+            kwargs['timeout'] = self._adaptive_timeout(
+                endpoint, kwargs.get('operation'))
+        return super(MarathonClient, self).request(
+            *args, url=endpoint, **kwargs)
+
+    def _adaptive_timeout(self, endpoint, operation):
+        """
+        Get the response header timeout for a request to an endpoint, based
+        on the response times observed for the endpoint and operation.
+        """
+        timeout = self.timeout_policy(operation).first_byte
+        response_time = self._response_time(endpoint, operation, 0.99)
+        if response_time is None:
+            return timeout
+
+        adapted = max(response_time * self.adaptive_timeout_factor,
+                      self.adaptive_timeout_min)
+        return adapted if timeout is None else min(adapted, timeout)
+
+    def _response_time(self, endpoint, operation, percentile):
+        """
+        Get a percentile of the response times observed for an endpoint and
+        operation, or None if too few have been observed.
+        """
+        response_times = self._response_times.get((endpoint, operation))
+        if (response_times is None or
+                len(response_times) < self.response_time_min_samples):
+            return None
+
+        response_times = sorted(response_times)
+        index = max(int(len(response_times) * percentile) - 1, 0)
+        return response_times[index]
+
+    def _probe_endpoint(self, endpoints):
+        """
+        Pick the endpoint to make a request to when the circuits of all of
+        ``endpoints`` are open: rather than not making the request at all,
+        probe the endpoint that is due to be tried again first.
+        """
+        endpoint = min(
+            endpoints, key=lambda e: self._breaker(e).cooldown_ends)
+        self.log.warn(
+            'All Marathon endpoints are failing, probing {endpoint}',
+            endpoint=_strip_userinfo(endpoint))
+        self._breaker(endpoint).force_probe()
+        return endpoint
+
+    def _breaker(self, endpoint):
+        breaker = self._breakers.get(endpoint)
+        if breaker is None:
+            breaker = self._breakers[endpoint] = CircuitBreaker(
+                self._reactor, self.failure_threshold, self.failure_cooldown)
+        return breaker
+
+    def endpoint_health(self):
+        """
+        Get the state of the circuit breaker for each endpoint and the number
+        of requests to it that have failed. Any credentials are removed from
+        the endpoints.
+        """
+        health = {}
+        for endpoint in self.endpoints:
+            breaker = self._breaker(endpoint)
+            health[_strip_userinfo(endpoint)] = {
+                'state': breaker.state,
+                'failures': breaker.failures,
+                'total_failures': breaker.total_failures,
+            }
+        return health
+
+    def _hedged_request(self, endpoints, *args, **kwargs):
+        """
+        Make a request to the first endpoint in ``endpoints`` and, each time
+        the latest endpoint tried hasn't responded within its hedge delay or
+        has failed, to the next endpoint as well. The first response is used
+        and the requests that are still in flight are abandoned.
+        """
+        endpoints = list(endpoints)
+        operation = kwargs.get('operation')
+        attempts = []
+        state = {'done': False, 'failure': None, 'timer': None, 'tried': 0}
+
+        def finish():
+            state['done'] = True
+            stop_hedging()
+            for attempt in list(attempts):
+                self.abandon(attempt)
+        result = Deferred(lambda _: finish())
+
+        def stop_hedging():
+            timer = state['timer']
+            if timer is not None and timer.active():
+                timer.cancel()
+            state['timer'] = None
+
+        def try_next():
+            stop_hedging()
+            skipped = []
+            while endpoints and not self._breaker(
+                    endpoints[0]).allow_request():
+                skipped.append(endpoints.pop(0))
+                self.log.debug(
+                    'Skipping failing Marathon endpoint {endpoint}',
+                    endpoint=skipped[-1])
+
+            if not endpoints and skipped and state['tried'] == 0:
+                # Every endpoint is failing but nothing has been tried yet
+                endpoints.append(self._probe_endpoint(skipped))
+
+            if not endpoints:
+                if not attempts:
+                    failure = state['failure']
+                    if failure is None:
+                        failure = Failure(RuntimeError(
+                            'No Marathon endpoints, not making request'))
+                    result.errback(failure)
+                return
+
+            endpoint = endpoints.pop(0)
+            state['tried'] += 1
+            started = self._reactor.seconds()
+            attempt = self._endpoint_request(endpoint, *args, **kwargs)
+            attempts.append(attempt)
+            if endpoints:
+                state['timer'] = self._reactor.callLater(
+                    self._hedge_delay(endpoint, operation), try_next)
+            attempt.addCallbacks(
+                succeeded, failed, callbackArgs=[attempt, endpoint, started],
+                errbackArgs=[attempt, endpoint])
+
+        def succeeded(response, attempt, endpoint, started):
+            attempts.remove(attempt)
+            self._endpoint_succeeded(response, endpoint, operation, started)
+            if state['done']:
+                return
+
+            finish()
+            result.callback(response)
+
+        def failed(failure, attempt, endpoint):
+            attempts.remove(attempt)
+            if state['done']:
+                # The request was abandoned
+                self._breaker(endpoint).record_abandoned()
+                return
+
+            self._endpoint_failed(failure, endpoint)
+            state['failure'] = failure
+            # Don't wait for the hedge delay before trying the next endpoint
+            try_next()
+
+        try_next()
+        return result
+
+    def _hedge_delay(self, endpoint, operation=None):
+        """
+        Get the number of seconds to wait for an endpoint to respond before
+        also making the request to the next endpoint.
+        """
+        response_time = self._response_time(endpoint, operation, 0.95)
+        return self.hedge_delay if response_time is None else response_time
+
+    def _endpoint_succeeded(self, response, endpoint, operation, started):
+        self._breaker(endpoint).record_success()
+        key = (endpoint, operation)
+        response_times = self._response_times.get(key)
+        if response_times is None:
+            response_times = self._response_times[key] = deque(
+                maxlen=self.response_time_samples)
+        response_times.append(self._reactor.seconds() - started)
+
+        # Stick with the endpoint so that later requests don't wait for
+        # endpoints that have failed before trying it
+        self._last_endpoint = endpoint
+        return response
+
+    def _endpoint_failed(self, failure, endpoint):
+        self._breaker(endpoint).record_failure()
+        if endpoint == self._leader_endpoint:
+            self._leader_endpoint = None
+        if endpoint == self._last_endpoint:
+            self._last_endpoint = None
+        return failure
+
+    def discover_leader(self):
+        """
+        Find the current Marathon leader, so that requests are sent straight
+        to it rather than being proxied to it by another Marathon instance.
+        Requests are only sent straight to the leader if it is one of the
+        endpoints.
+
+        :return:
+            A deferred that fires with the leader's endpoint, or None if the
+            leader isn't one of the endpoints.
+        """
+        d = self.get_json_field('leader', path='/v2/leader')
+
+        def set_leader(leader):
+            self._leader_endpoint = None
+            for endpoint in self.endpoints:
+                authority = urisplit(endpoint).authority
+                if authority is not None and (
+                        authority.rpartition('@')[2] == leader):
+                    self._leader_endpoint = endpoint
+                    break
+            return self._leader_endpoint
+        return d.addCallback(set_leader)
+
     def _log_all_endpoints_failed(self, failure):
         # Just log an error so it is clear what has happened and return the
         # final failure. Individual failures should have been logged via
@@ -297,7 +1019,7 @@ class MarathonClient(JsonClient):
         self.log.error('Failed to make a request to all Marathon endpoints')
         return failure
 
-    def get_json_field(self, field, **kwargs):
+    def get_json_field(self, field, item_handler=None, **kwargs):
         """
         Perform a GET request and get the contents of the JSON response.
 
@@ -309,10 +1031,26 @@ class MarathonClient(JsonClient):
         This method will raise an error if:
         * There is an error response code
         * The field with the given name cannot be found
+
+        :param item_handler:
+            If provided, the field must be an array. The response is parsed
+            incrementally and the handler is called with each item in the
+            array as soon as it has been received, without the whole response
+            being held in memory. The deferred fires with None.
         """
+        body_timeout = self.timeout_policy(kwargs.get('operation')).body
+        if item_handler is not None:
+            # Don't let treq buffer the whole response as it is received
+            d = self.request('GET', unbuffered=True, **kwargs)
+            d.addCallback(raise_for_status)
+            return d.addCallback(
+                json_field_items, field, item_handler, body_timeout,
+                self._reactor)
+
         d = self.request('GET', **kwargs)
         d.addCallback(raise_for_status)
-        d.addCallback(json_content)
+
+        d.addCallback(json_content, body_timeout, self._reactor)
         d.addCallback(self._get_json_field, field)
         return d
 
@@ -332,32 +1070,416 @@ class MarathonClient(JsonClient):
 
         return response_json[field_name]
 
-    def get_apps(self):
+    def clear_cache(self):
+        """
+        Forget all cached responses, so that the next request for any of them
+        is made in full. Requests made after this don't share the response to
+        a request that is already in flight.
+        """
+        self._cache = {}
+        self._in_flight = {}
+
+    def _get_cached_json(self, key, decode, **kwargs):
+        """
+        Perform a GET request for JSON content, sharing the response with any
+        identical requests and caching it for ``cache_ttl`` seconds.
+
+        :param key: The key that identifies the request in the cache.
+        :param decode:
+            A 1-arg callable that gets the value to cache from the JSON content
+            of the response as bytes, returning the value or a deferred that
+            fires with the value.
+        """
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            d = Deferred()
+            in_flight.append(d)
+            return d
+
+        cached = self._cache.get(key)
+        if (cached is not None and
+                self._reactor.seconds() - cached.fetched_at < self.cache_ttl):
+            return succeed(cached.content)
+
+        # Revalidate the cached response if the server told us how
+        headers = kwargs.pop('headers', {}).copy()
+        if cached is not None and cached.etag is not None:
+            headers['If-None-Match'] = cached.etag
+        if cached is not None and cached.last_modified is not None:
+            headers['If-Modified-Since'] = cached.last_modified
+
+        waiting = []
+        self._in_flight[key] = waiting
+        d = self.request('GET', headers=headers, **kwargs)
+        d.addCallback(raise_for_status)
+        d.addCallback(self._cache_json, key, decode, cached)
+
+        def notify_waiting(result):
+            if self._in_flight.get(key) is waiting:
+                del self._in_flight[key]
+            for waiting_d in waiting:
+                if isinstance(result, Failure):
+                    waiting_d.errback(result)
+                else:
+                    waiting_d.callback(result)
+            return result
+        return d.addBoth(notify_waiting)
+
+    def _cache_json(self, response, key, decode, cached):
+        fetched_at = self._reactor.seconds()
+        cache = self._cache
+        if response.code == NOT_MODIFIED and cached is not None:
+            cached.fetched_at = fetched_at
+            return cached.content
+
+        raise_for_header(response, 'Content-Type', 'application/json')
+        etag = get_single_header(response.headers, 'ETag')
+        last_modified = get_single_header(response.headers, 'Last-Modified')
+
+        def decode_content(content):
+            # Marathon doesn't send an ETag or Last-Modified header for most
+            # of its resources, so check whether the content has changed
+            # before decoding it again
+            digest = hashlib.sha256(content).hexdigest()
+            if cached is not None and cached.digest == digest:
+                d = succeed(cached.content)
+            else:
+                d = maybeDeferred(decode, content)
+            return d.addCallback(store, digest)
+
+        def store(decoded, digest):
+            # Don't cache the response if the cache was cleared in the meantime
+            if cache is self._cache:
+                cache[key] = _CachedResponse(
+                    decoded, fetched_at, digest, etag, last_modified)
+            return decoded
+
+        d = read_body(
+            response, self.timeout_policy('apps').body, self._reactor)
+        return d.addCallback(decode_content)
+
+    def _decode_json_field_items(self, content, field):
+        """
+        Decode the JSON content of a response and get the array in the given
+        field. Big documents are decoded a chunk at a time.
+
+        :return: A deferred that fires with the list of items in the array.
+        """
+        if len(content) < self.cooperative_decode_size:
+            return succeed(
+                self._get_json_field(json_codec.loads(content), field))
+
+        items = []
+        protocol = JsonFieldItemsProtocol(field, items.append)
+        finished = protocol.when_finished()
+        feed_body(content, protocol, self._reactor,
+                  self.cooperative_decode_chunk_size)
+        return finished.addCallback(lambda _: items)
+
+    def get_apps(self, label=None, group=None, app_handler=None):
         """
         Get the currently running Marathon apps, returning a list of app
         definitions.
+
+        :param label:
+            Only get apps with a label matching this label selector, either
+            ``KEY`` for apps with the label or ``KEY==VALUE`` for apps with the
+            label set to the value.
+        :param group:
+            Only get apps in this Marathon group (or any group nested in it),
+            e.g. ``/my-group``.
+        :param app_handler:
+            If provided, the handler is called with each app definition as
+            soon as it has been received rather than returning a list of all
+            the app definitions once they have all been received. If responses
+            are cached, the handler is instead called with each app definition
+            once the whole list is available.
+        """
+        if group is not None:
+            d = self._get_group_apps(group, label)
+            if app_handler is not None:
+                # The group's apps are nested in its groups so they can't be
+                # handled as they are received, hand them over once parsed
+                d.addCallback(_handle_items, app_handler)
+            return d
+
+        kwargs = {}
+        if label is not None:
+            kwargs['params'] = {'label': label}
+        if self.cache_ttl is not None:
+            d = self._get_cached_json(
+                ('apps', label),
+                lambda content: self._decode_json_field_items(content, 'apps'),
+                path='/v2/apps', operation='apps', **kwargs)
+            if app_handler is not None:
+                d.addCallback(_handle_items, app_handler)
+            return d
+
+        if app_handler is not None:
+            return self.get_json_field(
+                'apps', item_handler=app_handler, path='/v2/apps',
+                operation='apps', **kwargs)
+
+        # Collect the apps as they are received rather than decoding the whole
+        # list in one go once it has been received
+        apps = []
+        d = self.get_json_field(
+            'apps', item_handler=apps.append, path='/v2/apps',
+            operation='apps', **kwargs)
+        return d.addCallback(lambda _: apps)
+
+    def _get_group_apps(self, group, label):
+        """
+        Get the apps in a group and its nested groups. The groups endpoint
+        doesn't support label selectors so the apps are matched against the
+        label selector as they are collected.
+        """
+        def collect_apps(group_json, apps):
+            for app in group_json.get('apps', []):
+                if label is None or label_matches(label, app['labels']):
+                    apps.append(app)
+            for nested_group in group_json.get('groups', []):
+                collect_apps(nested_group, apps)
+            return apps
+
+        # Embed the apps and nested groups but none of the app details (such
+        # as tasks) that we don't need
+        kwargs = {
+            'path': '/v2/groups' + group.rstrip('/'),
+            'params': [('embed', 'group.apps'), ('embed', 'group.groups')],
+            'operation': 'apps',
+        }
+        if self.cache_ttl is not None:
+            return self._get_cached_json(
+                ('group', group, label),
+                lambda content: collect_apps(json_codec.loads(content), []),
+                **kwargs)
+
+        d = self.request('GET', **kwargs)
+        d.addCallback(raise_for_status)
+        d.addCallback(
+            json_content, self.timeout_policy('apps').body, self._reactor)
+        d.addCallback(collect_apps, [])
+        return d
+
+    def get_app(self, app_id):
+        """
+        Get the app definition for a single Marathon app.
+
+        :param app_id: The ID of the app, e.g. ``/my-app``.
         """
-        return self.get_json_field('apps', path='/v2/apps')
+        return self.get_json_field('app', path='/v2/apps' + app_id)
 
-    def get_events(self, callbacks):
+    def get_events(self, callbacks, timeout=None, last_event_id=None):
         """
         Attach to Marathon's event stream using Server-Sent Events (SSE).
 
+        The event stream is filtered on the server side (for Marathon versions
+        that support it) so that it only carries the event types that there
+        are callbacks for. Plan information is also excluded from deployment
+        events. Marathon versions that don't support these query parameters
+        ignore them and the events are filtered as they are received instead.
+
         :param callbacks:
             A dict mapping event types to functions that handle the event data
+        :param timeout:
+            The number of seconds that the event stream may be idle before the
+            connection is closed. If None, the stream may be idle indefinitely.
+        :param last_event_id:
+            The ID of the last event received on a previous connection to the
+            event stream. If provided, it is sent in the ``Last-Event-ID``
+            header so that the server can resume the stream after that event.
+        :return:
+            A deferred that fires with the ``SseProtocol`` when the stream is
+            closed. The protocol's ``last_event_id`` and ``retry`` attributes
+            can be used when reconnecting. When attached to several streams,
+            each lost stream is reattached to while the others are attached,
+            and the deferred fires with the protocol of the last stream to
+            close once all of them have been lost.
         """
-        d = self.request('GET', path='/v2/events', headers={
+        event_types = sorted(callbacks.keys())
+        params = [('event_type', event_type) for event_type in event_types]
+        params.append(('plan-format', 'light'))
+
+        headers = {
             'Accept': 'text/event-stream',
             'Cache-Control': 'no-store'
-        })
+        }
+        if last_event_id is not None:
+            headers['Last-Event-ID'] = last_event_id
+
+        # The event stream doesn't finish, so treq mustn't buffer it
+        kwargs = {
+            'path': '/v2/events',
+            'params': params,
+            'headers': headers,
+            'unbuffered': True,
+            'operation': 'events',
+        }
+        if timeout is None:
+            timeout = self.timeout_policy('events').body
+        # Only events that we have callbacks for are collected and decoded by
+        # the protocol, the rest are dropped as they are received
+        sse_kwargs = {
+            'event_types': event_types,
+            'timeout': timeout,
+            'reactor': self._reactor,
+        }
 
         def handler(event, data):
             callback = callbacks.get(event)
-            # Deserialize JSON if a callback is present
+            # Deserialize JSON if a callback is present. The callback may
+            # return a Deferred to hold off delivery of the next event.
             if callback is not None:
-                callback(json.loads(data))
+                return callback(json_codec.loads(data))
+
+        endpoints = self._endpoint_order()[:self.event_streams]
+        if len(endpoints) > 1:
+            return self._get_redundant_events(
+                endpoints, handler, kwargs, sse_kwargs)
+
+        # The event stream doesn't finish, so it can't be hedged
+        d = self.request('GET', hedge=False, **kwargs)
+        return d.addCallback(sse_content, handler, **sse_kwargs)
+
+    def _get_redundant_events(self, endpoints, handler, kwargs, sse_kwargs):
+        """
+        Attach to the event streams of several endpoints at once, passing each
+        event to the handler only once, whichever stream it arrives on first.
+
+        A stream that is lost, or that can't be attached to, is reattached
+        with backoff while the other streams are still attached or being
+        attached to. Once they have all been lost, the deferred fires with the
+        protocol of the last stream to close, or fails with the first error if
+        none of the streams could be attached to.
+        """
+        seen = set()
+        recent = deque()
+        # Handle the events one at a time in the order that they arrive, as
+        # they would be handled from a single stream
+        lock = DeferredLock()
+
+        def dedup_handler(event, data):
+            # Marathon doesn't give events IDs, but each event's data has a
+            # timestamp. Drop copies before their data is decoded.
+            key = (event, hashlib.sha1(data.encode('utf-8')).digest())
+            if key in seen:
+                self.duplicate_events += 1
+                return None
+
+            seen.add(key)
+            recent.append(key)
+            if len(recent) > self.event_dedup_window:
+                seen.discard(recent.popleft())
+            return lock.run(handler, event, data)
+
+        finished = Deferred()
+        # The requests and streams of the endpoints being attached to or
+        # attached, and the delayed calls to reattach to the others
+        streams = dict.fromkeys(endpoints)
+        reattaches = {}
+        attempts = dict.fromkeys(endpoints, 0)
+        attached_at = {}
+        closed = []
+        failures = []
+
+        def attach(endpoint, last_event_id=None):
+            reattaches.pop(endpoint, None)
+            stream_kwargs = kwargs
+            if last_event_id is not None:
+                headers = dict(kwargs['headers'])
+                headers['Last-Event-ID'] = last_event_id
+                stream_kwargs = dict(kwargs, headers=headers)
+
+            d = self._request(None, [endpoint], 'GET', **stream_kwargs)
+            streams[endpoint] = d
+            d.addCallback(stream_attached, endpoint)
+            d.addCallback(sse_content, dedup_handler, **sse_kwargs)
+            d.addBoth(stream_lost, endpoint, last_event_id)
+
+        def stream_attached(response, endpoint):
+            attached_at[endpoint] = self._reactor.seconds()
+            return response
+
+        def stream_lost(result, endpoint, last_event_id):
+            del streams[endpoint]
+            retry = None
+            if isinstance(result, Failure):
+                failures.append(result)
+            else:
+                closed.append(result)
+                retry = result.retry
+                if result.last_event_id is not None:
+                    last_event_id = result.last_event_id
+
+            if not streams:
+                # None of the other streams are left to wait on
+                for call in reattaches.values():
+                    call.cancel()
+                return all_lost(result, endpoint)
+
+            # Back off from the endpoint as the service does from the event
+            # stream, starting again once the stream has stayed attached
+            attached = attached_at.pop(endpoint, None)
+            if (attached is not None and
+                    self._reactor.seconds() - attached >=
+                    self.event_reattach_reset_time):
+                attempts[endpoint] = 0
+            delay = backoff_delay(attempts[endpoint],
+                                  self.event_reattach_delay_base,
+                                  self.event_reattach_delay_max)
+            attempts[endpoint] += 1
+            if retry:
+                delay = max(delay, retry / 1000.0)
+
+            if isinstance(result, Failure):
+                self.log.failure(
+                    'Failed to attach to the event stream at {endpoint}, '
+                    'reattaching in {delay:.1f}s...', result, LogLevel.warn,
+                    endpoint=_strip_userinfo(endpoint), delay=delay)
+            else:
+                self.log.warn(
+                    'Lost the event stream at {endpoint}, reattaching in '
+                    '{delay:.1f}s...', endpoint=_strip_userinfo(endpoint),
+                    delay=delay)
+            reattaches[endpoint] = self._reactor.callLater(
+                delay, attach, endpoint, last_event_id)
+
+        def all_lost(result, endpoint):
+            if closed:
+                if isinstance(result, Failure):
+                    self.log.failure(
+                        'Failed to attach to the event stream at '
+                        '{endpoint}', result, LogLevel.warn,
+                        endpoint=_strip_userinfo(endpoint))
+                finished.callback(closed[-1])
+            else:
+                # No stream could be attached to, fail with the first error
+                finished.errback(failures[0])
+
+        for endpoint in endpoints:
+            attach(endpoint)
+        return finished
+
 
-        return d.addCallback(sse_content, handler)
+def _strip_userinfo(url):
+    """
+    Remove any credentials from a URL so that it can be logged or reported.
+    """
+    split = urisplit(url)
+    if split.userinfo is None:
+        return url
+    return uricompose(
+        scheme=split.scheme, host=split.host, port=split.port,
+        path=split.path)
+
+
+def _handle_items(items, handler):
+    """
+    Callback to call the handler with each item in a list.
+    """
+    for item in items:
+        handler(item)
 
 
 class MarathonLbClient(HTTPClient):
@@ -0,0 +1,50 @@
+"""
+Encoding and decoding of JSON documents. The C-accelerated ``orjson`` library
+is used if it is installed, otherwise the standard library's ``json`` module is
+used. Either way, documents are decoded from and encoded to UTF-8 bytes.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _stdlib_loads(data):
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    return json.loads(data)
+
+
+def _stdlib_dumps(obj):
+    return json.dumps(obj).encode('utf-8')
+
+
+if orjson is not None:
+    backend = 'orjson'
+    _loads = orjson.loads
+    _dumps = orjson.dumps
+else:
+    backend = 'json'
+    _loads = _stdlib_loads
+    _dumps = _stdlib_dumps
+
+
+def loads(data):
+    """
+    Decode a JSON document.
+
+    :param data: The document, as UTF-8 bytes or as text.
+    :raises ValueError: If the document is not valid JSON.
+    """
+    return _loads(data)
+
+
+def dumps(obj):
+    """
+    Encode an object as a JSON document.
+
+    :return: The document as UTF-8 bytes.
+    """
+    return _dumps(obj)
@@ -0,0 +1,267 @@
+import codecs
+import json
+import re
+
+from twisted.internet.defer import Deferred
+from twisted.internet.protocol import connectionDone, Protocol
+from twisted.python.failure import Failure
+from twisted.web.client import ResponseDone
+from twisted.web.http import PotentialDataLoss
+
+# The characters that change the structure of a JSON document
+_STRUCTURAL_RE = re.compile(u'["{}\\[\\],:]')
+_WHITESPACE_RE = re.compile(u'[ \t\r\n]*')
+# The characters that a number can start with and that can follow an item
+_NUMBER_START = u'-0123456789'
+_ITEM_END = u' \t\r\n,]'
+
+
+class JsonFieldItemsProtocol(Protocol):
+    """
+    A protocol that incrementally parses a JSON object, calling a handler with
+    each item of the array in one of the object's fields as soon as that item
+    has been received. Only the text of the item currently being received is
+    kept in memory, rather than the whole document and the objects parsed from
+    it.
+
+    Each item is parsed by the standard JSON decoder. The rest of the document
+    is only scanned for its structure.
+    """
+
+    def __init__(self, field, handler):
+        """
+        :param field:
+            The name of the field in the top-level JSON object that holds the
+            array of items.
+        :param handler:
+            A 1-arg callable that will be called with each item in the array.
+        """
+        self._field = field
+        self._handler = handler
+        self._waiting = []
+
+        self._decoder = json.JSONDecoder()
+        self._utf8_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._text = u''
+        self._pos = 0
+
+        self._depth = 0
+        self._string_start = None
+        self._expect_key = False
+        self._key = None
+
+        self._in_items = False
+        self._expect_item = False
+        self._items = 0
+        # Don't try parse an incomplete item again until there's at least
+        # this much text, so that a large item received in many small chunks
+        # is not parsed from the start for every chunk.
+        self._retry_at = 0
+
+        self._found = False
+        self._done = False
+        self._error = None
+
+    def when_finished(self):
+        """
+        Get a deferred that will be fired with None once the whole document
+        has been received, or that will fail if the document could not be
+        parsed, the field was not found, or the handler raised an exception.
+        """
+        d = Deferred()
+        self._waiting.append(d)
+        return d
+
+    def dataReceived(self, data):
+        if self._error is not None or self._done:
+            return
+
+        try:
+            self._text += self._utf8_decoder.decode(data)
+            self._scan()
+        except Exception:
+            self._error = Failure()
+            self.transport.stopProducing()
+            return
+
+        # Discard the text that has been scanned and isn't still needed
+        keep_from = self._pos
+        if self._string_start is not None:
+            keep_from = self._string_start
+            self._string_start = 0
+        if keep_from > 0:
+            self._text = self._text[keep_from:]
+            self._pos -= keep_from
+            self._retry_at = max(self._retry_at - keep_from, 0)
+
+    def _scan(self):
+        while not self._done:
+            if self._in_items:
+                if not self._scan_items():
+                    return
+            elif self._string_start is not None:
+                if not self._scan_string():
+                    return
+            elif not self._scan_structure():
+                return
+
+    def _scan_structure(self):
+        """
+        Scan for the next character that changes the structure of the
+        document. Returns False if more text is needed.
+        """
+        match = _STRUCTURAL_RE.search(self._text, self._pos)
+        if match is None:
+            self._pos = len(self._text)
+            return False
+
+        pos = match.start()
+        self._pos = pos + 1
+        char = self._text[pos]
+        if char == u'"':
+            self._string_start = pos
+        elif char in u'{[':
+            self._open(char)
+        elif char in u'}]':
+            self._close(char)
+        elif char == u',' and self._depth == 1:
+            self._expect_key = True
+        elif char == u':' and self._depth == 1:
+            self._expect_key = False
+        return True
+
+    def _scan_string(self):
+        """
+        Scan for the end of the string that is being received. Returns False
+        if more text is needed.
+        """
+        text = self._text
+        while True:
+            end = text.find(u'"', self._pos)
+            if end == -1:
+                self._pos = len(text)
+                return False
+
+            self._pos = end + 1
+            # The quote is escaped if it is preceded by an odd number of
+            # backslashes
+            backslashes = 0
+            while text[end - backslashes - 1] == u'\\':
+                backslashes += 1
+            if backslashes % 2 == 0:
+                break
+
+        if self._depth == 1 and self._expect_key:
+            self._key = json.loads(text[self._string_start:end + 1])
+            self._expect_key = False
+        self._string_start = None
+        return True
+
+    def _open(self, char):
+        if self._depth == 0 and char != u'{':
+            raise ValueError('Expected a JSON object')
+
+        self._depth += 1
+        if self._depth == 1:
+            self._expect_key = True
+        elif (self._depth == 2 and char == u'[' and
+                self._key == self._field and not self._found):
+            self._found = True
+            self._in_items = True
+            self._expect_item = True
+
+    def _close(self, char):
+        self._depth -= 1
+        if self._depth < 0:
+            raise ValueError('Unexpected "%s"' % (char,))
+        elif self._depth == 0:
+            self._done = True
+
+    def _scan_items(self, final=False):
+        """
+        Parse the items in the array. Returns False if more text is needed.
+
+        :param final:
+            Whether the document has been received in full, so that an item
+            at the end of the text is not waiting for more text.
+        """
+        text = self._text
+        while True:
+            pos = _WHITESPACE_RE.match(text, self._pos).end()
+            self._pos = pos
+            if pos == len(text):
+                return False
+
+            char = text[pos]
+            if char == u']':
+                if self._expect_item and self._items > 0:
+                    raise ValueError(
+                        'Missing item in "%s" array' % (self._field,))
+                self._pos = pos + 1
+                self._in_items = False
+                self._close(char)
+                return True
+            elif not self._expect_item:
+                if char != u',':
+                    raise ValueError('Expected "," or "]" in "%s" array' % (
+                        self._field,))
+                self._pos = pos + 1
+                self._expect_item = True
+                continue
+
+            if not final and len(text) < self._retry_at:
+                return False
+            try:
+                item, end = self._decoder.raw_decode(text, pos)
+            except ValueError:
+                if final:
+                    raise
+                # Assume the item is incomplete and wait for more text
+                self._retry_at = len(text) + (len(text) - pos)
+                return False
+            if (not final and text[pos] in _NUMBER_START and
+                    (end == len(text) or text[end] not in _ITEM_END)):
+                # A number is only complete once the character after it has
+                # been received, the decoder may have stopped at a '.', 'e'
+                # or at the end of the text
+                return False
+
+            self._pos = end
+            self._expect_item = False
+            self._retry_at = 0
+            self._items += 1
+            self._handler(item)
+
+    def connectionLost(self, reason=connectionDone):
+        if self._error is None:
+            if not reason.check(ResponseDone, PotentialDataLoss):
+                self._error = reason
+            else:
+                self._finish()
+
+        for d in list(self._waiting):
+            if self._error is None:
+                d.callback(None)
+            else:
+                d.errback(self._error)
+        self._waiting = []
+
+    def _finish(self):
+        """
+        Parse any item that was waiting for more text and check that the
+        document was complete.
+        """
+        try:
+            if self._in_items:
+                self._scan_items(final=True)
+                self._scan()
+        except Exception:
+            self._error = Failure()
+            return
+
+        if not self._done:
+            self._error = Failure(ValueError('Incomplete JSON document'))
+        elif not self._found:
+            self._error = Failure(KeyError(
+                'Unable to get value for "%s" from Marathon response' % (
+                    self._field,)))
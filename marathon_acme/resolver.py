@@ -0,0 +1,144 @@
+from functools import partial
+
+from twisted.internet.interfaces import (
+    IHostnameResolver, IHostResolution, IResolutionReceiver)
+from zope.interface import implementer
+
+
+@implementer(IHostResolution)
+class _HostResolution(object):
+    """
+    A resolution of a name for one receiver. Cancelling it stops the
+    addresses from being delivered to the receiver, but the name is still
+    resolved and cached for the other receivers.
+    """
+
+    def __init__(self, name, canceller):
+        self.name = name
+        self._canceller = canceller
+
+    def cancel(self):
+        self._canceller()
+
+
+@implementer(IResolutionReceiver)
+class _CollectingReceiver(object):
+    """
+    A resolution receiver that collects the resolved addresses and calls a
+    callback with them once the resolution is complete.
+    """
+
+    def __init__(self, callback):
+        self._callback = callback
+        self._addresses = []
+
+    def resolutionBegan(self, resolution):
+        pass
+
+    def addressResolved(self, address):
+        self._addresses.append(address)
+
+    def resolutionComplete(self):
+        self._callback(self._addresses)
+
+
+def _deliver(receiver, addresses):
+    for address in addresses:
+        receiver.addressResolved(address)
+    receiver.resolutionComplete()
+
+
+class _CachedAddresses(object):
+    def __init__(self, addresses, resolved_at):
+        self.addresses = addresses
+        self.resolved_at = resolved_at
+
+
+@implementer(IHostnameResolver)
+class CachingHostnameResolver(object):
+    """
+    An ``IHostnameResolver`` that caches the addresses resolved by another
+    resolver, so that each new connection to a host doesn't have to wait for
+    the host's name to be resolved again. Counts how many resolutions were
+    answered from the cache and how many were not.
+
+    The system resolver doesn't give the TTLs of the DNS records that it
+    resolves, so addresses are cached for a fixed number of seconds. If the
+    name can't be resolved again once they expire, the expired addresses are
+    used for a limited time longer.
+    """
+
+    def __init__(self, resolver, clock, ttl=60, max_stale=300):
+        """
+        :param resolver: The ``IHostnameResolver`` to resolve names with.
+        :param clock: The ``IReactorTime`` provider to use.
+        :param ttl: The number of seconds to cache addresses for.
+        :param max_stale:
+            The number of seconds after addresses expire that they may still
+            be used if the name can't be resolved.
+        """
+        self._resolver = resolver
+        self._clock = clock
+        self.ttl = ttl
+        self.max_stale = max_stale
+
+        self._cache = {}
+        self._resolving = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    def resolveHostName(self, resolutionReceiver, hostName, portNumber=0,
+                        addressTypes=None, transportSemantics='TCP'):
+        if addressTypes is not None:
+            addressTypes = frozenset(addressTypes)
+        key = (hostName, portNumber, addressTypes, transportSemantics)
+
+        resolution = _HostResolution(
+            hostName, partial(self._cancel, key, resolutionReceiver))
+        resolutionReceiver.resolutionBegan(resolution)
+
+        cached = self._cache.get(key)
+        if (cached is not None and
+                self._clock.seconds() - cached.resolved_at < self.ttl):
+            self.hits += 1
+            _deliver(resolutionReceiver, cached.addresses)
+            return resolution
+
+        self.misses += 1
+        # Share a resolution that is already in progress
+        receivers = self._resolving.get(key)
+        if receivers is not None:
+            receivers.append(resolutionReceiver)
+            return resolution
+
+        self._resolving[key] = [resolutionReceiver]
+        self._resolver.resolveHostName(
+            _CollectingReceiver(partial(self._resolved, key)), hostName,
+            portNumber, addressTypes, transportSemantics)
+        return resolution
+
+    def _cancel(self, key, receiver):
+        # Resolutions that have completed can't be cancelled
+        receivers = self._resolving.get(key, [])
+        if receiver in receivers:
+            receivers.remove(receiver)
+
+    def _resolved(self, key, addresses):
+        receivers = self._resolving.pop(key)
+        now = self._clock.seconds()
+        if addresses:
+            self._cache[key] = _CachedAddresses(addresses, now)
+        else:
+            cached = self._cache.pop(key, None)
+            if (cached is not None and
+                    now - cached.resolved_at < self.ttl + self.max_stale):
+                self.stale += 1
+                addresses = cached.addresses
+                # Keep using the stale addresses until the limit, but try to
+                # resolve the name again for each new connection
+                self._cache[key] = cached
+
+        for receiver in receivers:
+            _deliver(receiver, addresses)
@@ -1,15 +1,15 @@
-import json
-
 from klein import Klein
 from twisted.internet.endpoints import serverFromString
 from twisted.logger import Logger
 from twisted.web.http import OK, NOT_IMPLEMENTED, SERVICE_UNAVAILABLE
 from twisted.web.server import Site
 
+from marathon_acme import json_codec
+
 
 def write_request_json(request, json_obj):
     request.setHeader('Content-Type', 'application/json')
-    request.write(json.dumps(json_obj).encode('utf-8'))
+    request.write(json_codec.dumps(json_obj))
 
 
 class MarathonAcmeServer(object):
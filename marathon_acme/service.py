@@ -1,11 +1,16 @@
-from twisted.internet.defer import gatherResults
+import re
+
+from requests.exceptions import HTTPError
+from twisted.internet.defer import Deferred, DeferredSemaphore, gatherResults
+from twisted.internet.task import deferLater
 from twisted.logger import Logger, LogLevel
 from twisted.python.failure import Failure
 from txacme.challenges import HTTP01Responder
 from txacme.client import ServerError as txacme_ServerError
 from txacme.service import AcmeIssuingService
 
-from marathon_acme.server import MarathonAcmeServer
+from marathon_acme.clients import backoff_delay, label_matches
+from marathon_acme.server import Health, MarathonAcmeServer
 from marathon_acme.acme_util import MlbCertificateStore
 
 
@@ -19,11 +24,74 @@ def parse_domain_label(domain_label):
     return domains
 
 
+# The deployment actions that can change an app's definition. Other actions,
+# such as scaling an app, can't change its labels or ports.
+APP_CONFIG_ACTIONS = frozenset(['StartApplication', 'RestartApplication'])
+
+# The labels that can change the domains for an app
+ACME_LABEL_PATTERN = re.compile(
+    r'^(HAPROXY_(\d+_)?GROUP|MARATHON_ACME_\d+_DOMAIN)$')
+
+
+def app_fingerprint(app):
+    """
+    Get a fingerprint of the parts of an app definition that the domains for
+    the app are found from: the number of ports and the group and domain
+    labels. Apps with the same fingerprint have the same domains.
+    """
+    # Prefer the 'portDefinitions' field added in Marathon 1.0.0 but fall back
+    # to the deprecated 'ports' array if that's not present.
+    if 'portDefinitions' in app:
+        ports = app['portDefinitions']
+    else:
+        ports = app['ports']
+
+    labels = sorted((key, value) for key, value in app['labels'].items()
+                    if ACME_LABEL_PATTERN.match(key))
+    return len(ports), tuple(labels)
+
+
+def app_config_version(app):
+    """
+    Get the version of the configuration of an app definition. Prefer the
+    time of the last config change as the version also changes when the app is
+    scaled or restarted. Returns None if the app definition has no version.
+    """
+    version_info = app.get('versionInfo')
+    if version_info and version_info.get('lastConfigChangeAt'):
+        return version_info['lastConfigChangeAt']
+    return app.get('version')
+
+
+class _AppIndexRebuild(object):
+    """
+    The index of app domains, fingerprints and config versions being rebuilt
+    from the apps fetched by a full sync.
+    """
+
+    def __init__(self):
+        self.domains = {}
+        self.fingerprints = {}
+        self.versions = {}
+        self.changed = 0
+
+
 class MarathonAcme(object):
+    # Reconnects to the event stream back off exponentially from the base
+    # delay up to the maximum delay (in seconds). The backoff is reset once the
+    # event stream has stayed attached for the reset time.
+    reconnect_delay_base = 1
+    reconnect_delay_max = 60
+    reconnect_reset_time = 60
+    # The maximum number of apps to fetch at once after a deployment
+    app_fetch_concurrency = 4
+
     log = Logger()
 
     def __init__(self, marathon_client, group, cert_store, mlb_client,
-                 txacme_client_creator, reactor, email=None):
+                 txacme_client_creator, reactor, email=None,
+                 event_stream_timeout=None, sync_delay=0, app_label=None,
+                 app_group=None, connection_pool=None, name_resolver=None):
         """
         Create the marathon-acme service.
 
@@ -34,13 +102,38 @@ class MarathonAcme(object):
         :param txacme_client_creator: Callable to create the txacme client.
         :param reactor: The reactor to use.
         :param email: The ACME registration email.
+        :param event_stream_timeout:
+            The number of seconds the Marathon event stream may be idle before
+            it is reconnected. If None, the stream may be idle indefinitely.
+        :param sync_delay:
+            The number of seconds to wait after an event before syncing, so
+            that events received within that time trigger a single sync.
+        :param app_label:
+            Only consider Marathon apps with a label matching this label
+            selector (``KEY`` or ``KEY==VALUE``).
+        :param app_group:
+            Only consider Marathon apps in this Marathon group.
+        :param connection_pool:
+            The ``CountingHTTPConnectionPool`` shared by the clients, if any,
+            so that its connection counts can be reported in the health
+            check.
+        :param name_resolver:
+            The ``CachingHostnameResolver`` installed on the reactor, if any,
+            so that its cache counts can be reported in the health check.
         """
         self.marathon_client = marathon_client
         self.group = group
         self.reactor = reactor
+        self.event_stream_timeout = event_stream_timeout
+        self.sync_delay = sync_delay
+        self.app_label = app_label
+        self.app_group = app_group
+        self.connection_pool = connection_pool
+        self.name_resolver = name_resolver
 
         responder = HTTP01Responder()
         self.server = MarathonAcmeServer(responder.resource)
+        self.server.set_health_handler(self.health)
 
         mlb_cert_store = MlbCertificateStore(cert_store, mlb_client)
         self.txacme_service = AcmeIssuingService(
@@ -48,6 +141,64 @@ class MarathonAcme(object):
 
         self._server_listening = None
 
+        self._attached = False
+        self._attached_at = None
+        self._resuming = False
+        self._reconnects = 0
+        self._reconnect_attempts = 0
+        self._reconnect_delay = 0
+
+        self._sync_generation = 0
+        self._sync_waiters = []
+        self._sync_call = None
+        self._sync_running = False
+
+        # Index of app ID to the domains for that app, kept up to date by
+        # events between full syncs
+        self._app_domains = {}
+        # Fingerprints of the apps whose certificates are up to date, so that
+        # events that don't change an app's domains can be skipped
+        self._app_fingerprints = {}
+        self._app_updates_skipped = 0
+        # The config versions of the apps the domains were found for, so that
+        # full syncs only need to find the domains for apps that changed
+        self._app_versions = {}
+        # Sets of the app IDs updated by events while full syncs are fetching
+        # the apps, so that the fetched apps don't overwrite newer updates
+        self._app_updates = []
+
+    def health(self):
+        """
+        Get the health of the service, including the state of the connection
+        to the Marathon event stream and of the Marathon endpoints.
+        """
+        health = {
+            'event_stream': {
+                'attached': self._attached,
+                'reconnects': self._reconnects,
+                'reconnect_attempts': self._reconnect_attempts,
+                'reconnect_delay': self._reconnect_delay,
+            },
+            'apps': {
+                'indexed': len(self._app_domains),
+                'updates_skipped': self._app_updates_skipped,
+            },
+            'marathon_endpoints': self.marathon_client.endpoint_health(),
+        }
+        if self.connection_pool is not None:
+            health['connections'] = {
+                'requests': self.connection_pool.requests,
+                'opened': self.connection_pool.connections,
+                'reused': self.connection_pool.reused,
+            }
+        if self.name_resolver is not None:
+            health['dns_cache'] = {
+                'hits': self.name_resolver.hits,
+                'misses': self.name_resolver.misses,
+                'stale': self.name_resolver.stale,
+            }
+        return Health(True, health)
+
     def run(self, endpoint_description):
         self.log.info('Starting marathon-acme...')
 
@@ -82,24 +233,42 @@ class MarathonAcme(object):
                 self.txacme_service.stopService()
             ], consumeErrors=True)
 
-    def listen_events(self, reconnects=0):
+    def listen_events(self, reconnects=0, last_event_id=None):
         """
         Start listening for events from Marathon, running a sync when we first
-        successfully subscribe and triggering a sync on API request events.
+        successfully subscribe and updating the apps and their certificates as
+        events about apps are received.
+
+        :param reconnects:
+            The number of times we have reconnected to the event stream.
+        :param last_event_id:
+            The ID of the last event received before the previous connection
+            was lost. If provided, the event stream is resumed from that event
+            and the initial sync is skipped as no events were missed.
         """
         self.log.info('Listening for events from Marathon...')
         self._attached = False
+        self._resuming = last_event_id is not None
+        self._reconnects = reconnects
 
-        def on_finished(result, reconnects):
+        def on_finished(protocol, reconnects):
             # If the callback fires then the HTTP request to the event stream
             # went fine, but the persistent connection for the SSE stream was
-            # dropped. Just reconnect for now- if we can't actually connect
-            # then the errback will fire rather.
+            # dropped. Reconnect, backing off if the connection keeps dropping-
+            # if we can't actually connect then the errback will fire rather.
+            self._attached = False
+            delay = self._next_reconnect_delay(protocol.retry)
             self.log.warn('Connection lost listening for events, '
-                          'reconnecting... ({reconnects} so far)',
-                          reconnects=reconnects)
+                          'reconnecting in {delay:.1f}s... ({reconnects} so '
+                          'far, attempt {attempt} since last healthy)',
+                          delay=delay, reconnects=reconnects,
+                          attempt=self._reconnect_attempts)
             reconnects += 1
-            return self.listen_events(reconnects)
+            if delay > 0:
+                return deferLater(
+                    self.reactor, delay, self.listen_events, reconnects,
+                    protocol.last_event_id)
+            return self.listen_events(reconnects, protocol.last_event_id)
 
         def log_failure(failure):
             self.log.failure('Failed to listen for events', failure)
@@ -107,8 +276,38 @@ class MarathonAcme(object):
 
         return self.marathon_client.get_events({
             'event_stream_attached': self._sync_on_event_stream_attached,
-            'api_post_event': self._sync_on_api_post_event
-        }).addCallbacks(on_finished, log_failure, callbackArgs=[reconnects])
+            'api_post_event': self._sync_on_api_post_event,
+            'app_terminated_event': self._sync_on_app_terminated_event,
+            'deployment_success': self._sync_on_deployment_success,
+        }, timeout=self.event_stream_timeout, last_event_id=last_event_id
+        ).addCallbacks(on_finished, log_failure, callbackArgs=[reconnects])
+
+    def _next_reconnect_delay(self, retry=None):
+        """
+        Get the delay in seconds before the next reconnect to the event
+        stream. The first reconnect after the stream was healthy is immediate,
+        after that the delay backs off exponentially with jitter.
+
+        :param retry:
+            The reconnection time in milliseconds advertised by the server, if
+            any. The delay will be at least this long.
+        """
+        if (self._attached_at is not None and
+                self.reactor.seconds() - self._attached_at >=
+                self.reconnect_reset_time):
+            self._reconnect_attempts = 0
+        self._attached_at = None
+
+        delay = backoff_delay(self._reconnect_attempts,
+                              self.reconnect_delay_base,
+                              self.reconnect_delay_max)
+        self._reconnect_attempts += 1
+
+        if retry:
+            delay = max(delay, retry / 1000.0)
+
+        self._reconnect_delay = delay
+        return delay
 
     def _sync_on_event_stream_attached(self, event):
         if self._attached:
@@ -120,18 +319,268 @@ class MarathonAcme(object):
             return
 
         self._attached = True
+        self._attached_at = self.reactor.seconds()
+        self._reconnect_delay = 0
+        # The leader may have changed while we were detached
+        self._discover_leader()
+        if self._resuming:
+            self.log.info(
+                'event_stream_attached event received (timestamp: '
+                '"{timestamp}", remoteAddress: "{remoteAddress}"), resumed '
+                'event stream so skipping initial sync',
+                timestamp=event['timestamp'],
+                remoteAddress=event['remoteAddress'])
+            return
+
         self.log.info(
             'event_stream_attached event received (timestamp: "{timestamp}", '
             'remoteAddress: "{remoteAddress}"), running initial sync...',
             timestamp=event['timestamp'], remoteAddress=event['remoteAddress'])
-        return self.sync()
+        # Don't hold up the event stream while the sync runs, so that events
+        # that arrive in the meantime can be coalesced into the next sync
+        self.schedule_sync()
+
+    def _discover_leader(self):
+        def log_failure(failure):
+            self.log.failure(
+                'Unable to discover the Marathon leader', failure,
+                LogLevel.warn)
+        return self.marathon_client.discover_leader().addErrback(log_failure)
 
     def _sync_on_api_post_event(self, event):
+        app = event.get('appDefinition')
+        if app is None:
+            self.log.info(
+                'api_post_event event received (timestamp: "{timestamp}", '
+                'uri: "{uri}") without an app definition, triggering a '
+                'sync...', timestamp=event['timestamp'], uri=event['uri'])
+            self.schedule_sync()
+            return
+
         self.log.info(
             'api_post_event event received (timestamp: "{timestamp}", uri: '
-            '"{uri}"), triggering a sync...', timestamp=event['timestamp'],
-            uri=event['uri'])
-        return self.sync()
+            '"{uri}"), updating app {app}...', timestamp=event['timestamp'],
+            uri=event['uri'], app=app.get('id'))
+        self._sync_app(app)
+
+    def _sync_on_app_terminated_event(self, event):
+        self.log.info(
+            'app_terminated_event event received (timestamp: "{timestamp}", '
+            'appId: "{app_id}"), removing app...',
+            timestamp=event['timestamp'], app_id=event['appId'])
+        self._index_app_domains(event['appId'], None)
+
+    def _sync_on_deployment_success(self, event):
+        try:
+            actions = [action for step in event['plan']['steps']
+                       for action in step['actions']]
+        except (KeyError, TypeError):
+            self.log.warn(
+                'deployment_success event received (timestamp: '
+                '"{timestamp}") without a deployment plan, triggering a '
+                'sync...', timestamp=event.get('timestamp'))
+            self.schedule_sync()
+            return
+
+        # Skip the actions that aren't for apps, such as pod actions
+        app_actions = [action for action in actions
+                       if action.get('app') is not None]
+        stopped = set(action['app'] for action in app_actions
+                      if action.get('action') == 'StopApplication')
+        changed = set(action['app'] for action in app_actions
+                      if action.get('action') in APP_CONFIG_ACTIONS)
+        changed -= stopped
+        # The apps that the deployment changed have the plan's version. Apps
+        # indexed at that version or later, from the api_post_event that
+        # started the deployment, are already up to date.
+        version = event['plan'].get('version')
+        updated = set(app_id for app_id in changed
+                      if not self._app_indexed_since(app_id, version))
+        self.log.info(
+            'deployment_success event received (timestamp: "{timestamp}"), '
+            'updating {len_updated} apps and removing {len_stopped} apps '
+            '({len_current} already up to date)...',
+            timestamp=event['timestamp'], len_updated=len(updated),
+            len_stopped=len(stopped), len_current=len(changed - updated))
+
+        for app_id in sorted(stopped):
+            self._index_app_domains(app_id, None)
+
+        # Hold up the event stream until the index has been updated so that
+        # later events about the same apps are applied after these updates.
+        # Don't fetch every app in a big deployment at once.
+        semaphore = DeferredSemaphore(self.app_fetch_concurrency)
+        return gatherResults([semaphore.run(self._fetch_app, app_id)
+                              for app_id in sorted(updated)])
+
+    def _app_indexed_since(self, app_id, version):
+        """
+        Check whether an app has been indexed from a definition with a config
+        version at least as recent as the given version. Marathon's versions
+        are ISO 8601 timestamps in UTC, so they can be compared as strings.
+        """
+        indexed = self._app_versions.get(app_id)
+        return (version is not None and indexed is not None and
+                indexed >= version)
+
+    def _fetch_app(self, app_id):
+        """
+        Fetch an app from Marathon and update it. If the app no longer exists,
+        it is removed. If the app can't be fetched, a full sync is triggered.
+        """
+        def fetch_failed(failure):
+            if (failure.check(HTTPError) and
+                    failure.value.response is not None and
+                    failure.value.response.code == 404):
+                self._index_app_domains(app_id, None)
+                return
+
+            self.log.failure(
+                'Failed to fetch app {app}, triggering a sync...', failure,
+                LogLevel.warn, app=app_id)
+            self.schedule_sync()
+
+        d = self.marathon_client.get_app(app_id)
+        d.addCallbacks(self._sync_app, fetch_failed)
+        return d
+
+    def _sync_app(self, app):
+        """
+        Update the domains for the given app definition and issue certificates
+        for any new domains. If the labels and ports that the domains are found
+        from haven't changed, nothing needs to be done. If the app definition
+        can't be understood, a full sync is triggered.
+        """
+        app_id = app.get('id')
+        try:
+            if not self._app_in_scope(app):
+                self.log.debug('App {app} is not in scope, ignoring',
+                               app=app_id)
+                self._index_app_domains(app_id, None)
+                return
+
+            fingerprint = app_fingerprint(app)
+            if self._app_fingerprints.get(app_id) == fingerprint:
+                # The indexed domains are up to date for this version too
+                self._app_versions[app_id] = app_config_version(app)
+                self._app_updates_skipped += 1
+                self.log.debug(
+                    'Domain labels and ports unchanged for app {app}, '
+                    'skipping ({skipped} skipped so far)', app=app_id,
+                    skipped=self._app_updates_skipped)
+                return
+
+            domains = self._app_acme_domains(app)
+        except KeyError:
+            self.log.failure(
+                'Unable to get domains for app {app}, triggering a sync...',
+                None, LogLevel.warn, app=app_id)
+            self.schedule_sync()
+            return
+
+        self._index_app_domains(
+            app_id, domains, fingerprint, app_config_version(app))
+        if not domains:
+            return
+
+        def forget_fingerprint():
+            # Make sure that the next event for the app tries to issue the
+            # certificates again
+            if self._app_fingerprints.get(app_id) == fingerprint:
+                del self._app_fingerprints[app_id]
+
+        def check_issued(_):
+            if unissued:
+                forget_fingerprint()
+
+        def log_failure(failure):
+            forget_fingerprint()
+            self.log.failure('Failed to issue certificates for app {app}',
+                             failure, LogLevel.error, app=app_id)
+
+        # Don't wait for the certificates to be issued
+        unissued = set()
+        d = self._filter_new_domains(domains)
+        d.addCallback(self._issue_certs, unissued)
+        d.addCallback(check_issued)
+        d.addErrback(log_failure)
+
+    def _app_in_scope(self, app):
+        """
+        Check whether an app is in the group and has the label that apps are
+        fetched for, if any.
+        """
+        if (self.app_group is not None and
+                not app['id'].startswith(self.app_group.rstrip('/') + '/')):
+            return False
+        return (self.app_label is None or
+                label_matches(self.app_label, app['labels']))
+
+    def _index_app_domains(self, app_id, domains, fingerprint=None,
+                           version=None):
+        """
+        Set the domains (and the fingerprint and config version of the app
+        definition they were found from) for an app in the index, or remove
+        the app from the index if ``domains`` is None.
+        """
+        for updates in self._app_updates:
+            updates.add(app_id)
+        # A cached list of apps from before this update is now out of date
+        self.marathon_client.clear_cache()
+
+        if domains is None:
+            self._app_domains.pop(app_id, None)
+            self._app_fingerprints.pop(app_id, None)
+            self._app_versions.pop(app_id, None)
+        else:
+            self._app_domains[app_id] = domains
+            self._app_fingerprints[app_id] = fingerprint
+            self._app_versions[app_id] = version
+
+    def schedule_sync(self):
+        """
+        Schedule a sync. Syncs scheduled within ``sync_delay`` seconds of each
+        other are coalesced into one and only one sync runs at a time: syncs
+        scheduled while a sync is running are coalesced into a single sync that
+        runs once it has completed.
+
+        :return:
+            A deferred that fires with None once a sync that started after this
+            call has completed (successfully or not).
+        """
+        self._sync_generation += 1
+        d = Deferred()
+        self._sync_waiters.append(d)
+
+        if self._sync_running or self._sync_call is not None:
+            self.log.debug(
+                'Sync already {state}, coalescing sync {generation}',
+                state='running' if self._sync_running else 'scheduled',
+                generation=self._sync_generation)
+        elif self.sync_delay:
+            self._sync_call = self.reactor.callLater(
+                self.sync_delay, self._run_scheduled_sync)
+        else:
+            self._run_scheduled_sync()
+
+        return d
+
+    def _run_scheduled_sync(self):
+        self._sync_call = None
+        self._sync_running = True
+        waiters, self._sync_waiters = self._sync_waiters, []
+
+        def finished(_):
+            # Failures have already been logged by the sync
+            self._sync_running = False
+            for d in waiters:
+                d.callback(None)
+
+            # Run the trailing sync for anything scheduled in the meantime
+            if self._sync_waiters and self._sync_call is None:
+                self._run_scheduled_sync()
+
+        self._sync(self._sync_generation).addBoth(finished)
 
     def sync(self):
         """
@@ -139,6 +588,15 @@ class MarathonAcme(object):
         certificates, and issue certificates for any domains that don't already
         have a certificate.
         """
+        return self._sync()
+
+    def _sync(self, generation=None):
+        """
+        :param generation:
+            The generation of the scheduled sync. If another sync has been
+            scheduled by the time the apps have been fetched, the apps are
+            stale and are dropped- the next sync will fetch them again.
+        """
         self.log.info('Starting a sync...')
 
         def log_success(result):
@@ -149,16 +607,108 @@ class MarathonAcme(object):
             self.log.failure('Sync failed', failure, LogLevel.error)
             return failure
 
-        return (self.marathon_client.get_apps()
-                .addCallback(self._apps_acme_domains)
-                .addCallback(self._filter_new_domains)
-                .addCallback(self._issue_certs)
+        updates = set()
+        self._app_updates.append(updates)
+        rebuild = _AppIndexRebuild()
+
+        def fetched(result):
+            self._app_updates.remove(updates)
+            return result
+
+        def index_app(app):
+            self._index_app(app, rebuild)
+
+        # Index the apps as they are received so that the full list of apps
+        # doesn't need to be kept in memory
+        d = self.marathon_client.get_apps(
+            label=self.app_label, group=self.app_group, app_handler=index_app)
+        return (d.addBoth(fetched)
+                .addCallback(lambda _: self._sync_apps(
+                    rebuild, updates, generation))
                 .addCallbacks(log_success, log_failure))
 
-    def _apps_acme_domains(self, apps):
+    def _sync_apps(self, rebuild, updates, generation):
+        if generation is not None and generation != self._sync_generation:
+            self.log.info(
+                'Sync {generation} superseded by sync {latest} while fetching '
+                'apps, dropping results', generation=generation,
+                latest=self._sync_generation)
+            return []
+
+        def forget_unissued(results):
+            # Make sure the next events for the apps with domains that
+            # certificates weren't issued for try again
+            if unissued:
+                for app_id, domains in self._app_domains.items():
+                    if unissued.intersection(domains):
+                        self._app_fingerprints.pop(app_id, None)
+            return results
+
+        def forget_fingerprints(failure):
+            # Some certificates may not have been issued, make sure the next
+            # events for the apps try again
+            self._app_fingerprints = {}
+            return failure
+
+        self._index_apps(rebuild, updates)
+        unissued = set()
+        d = self._filter_new_domains(self._apps_acme_domains())
+        d.addCallback(self._issue_certs, unissued)
+        d.addCallback(forget_unissued)
+        return d.addErrback(forget_fingerprints)
+
+    def _index_app(self, app, rebuild):
+        """
+        Add an app to an index that is being rebuilt. The domains are only
+        found again if the app's config version has changed since the app was
+        last indexed.
+        """
+        app_id = app['id']
+        version = app_config_version(app)
+        if (version is not None and app_id in self._app_domains and
+                self._app_versions.get(app_id) == version):
+            rebuild.domains[app_id] = self._app_domains[app_id]
+            rebuild.fingerprints[app_id] = self._app_fingerprints.get(app_id)
+        else:
+            rebuild.domains[app_id] = self._app_acme_domains(app)
+            rebuild.fingerprints[app_id] = app_fingerprint(app)
+            rebuild.changed += 1
+        rebuild.versions[app_id] = version
+
+    def _index_apps(self, rebuild, updates):
+        """
+        Replace the index of app domains with a rebuilt index, keeping any
+        updates from events since the apps were fetched. Apps that weren't
+        fetched are dropped.
+
+        :param updates:
+            The IDs of the apps that were updated while the apps were fetched.
+        """
+        index = rebuild.domains
+        fingerprints = rebuild.fingerprints
+        versions = rebuild.versions
+        for app_id in updates:
+            if app_id in self._app_domains:
+                index[app_id] = self._app_domains[app_id]
+                fingerprints[app_id] = self._app_fingerprints.get(app_id)
+                versions[app_id] = self._app_versions.get(app_id)
+            else:
+                index.pop(app_id, None)
+                fingerprints.pop(app_id, None)
+                versions.pop(app_id, None)
+
+        self.log.debug(
+            'Found domains for {changed} of {len_apps} apps, the rest are '
+            'unchanged', changed=rebuild.changed, len_apps=len(index))
+
+        self._app_domains = index
+        self._app_fingerprints = fingerprints
+        self._app_versions = versions
+
+    def _apps_acme_domains(self):
         domains = []
-        for app in apps:
-            domains.extend(self._app_acme_domains(app))
+        for app_id in sorted(self._app_domains):
+            domains.extend(self._app_domains[app_id])
 
         self.log.debug('Found {len_domains} domains for apps: {domains}',
                        len_domains=len(domains), domains=domains)
@@ -212,18 +762,23 @@ class MarathonAcme(object):
         d.addCallback(filter_domains)
         return d
 
-    def _issue_certs(self, domains):
+    def _issue_certs(self, domains, unissued=None):
         if domains:
             self.log.info(
                 'Issuing certificates for {len_domains} domains: {domains}',
                 len_domains=len(domains), domains=domains)
         else:
             self.log.debug('No new domains to issue certificates for')
-        return gatherResults([self._issue_cert(domain) for domain in domains])
+        return gatherResults(
+            [self._issue_cert(domain, unissued) for domain in domains])
 
-    def _issue_cert(self, domain):
+    def _issue_cert(self, domain, unissued=None):
         """
         Issue a certificate for the given domain.
+
+        :param unissued:
+            A set to add the domain to if the certificate couldn't be issued
+            because of an ACME server error that is ignored.
         """
         def errback(failure):
             # Don't fail on some of the errors we could get from the ACME
@@ -243,6 +798,8 @@ class MarathonAcme(object):
                     'Error ({code}) issuing certificate for "{domain}": '
                     '{detail}', code=acme_error_code, domain=domain,
                     detail=acme_error.detail)
+                if unissued is not None:
+                    unissued.add(domain)
             else:
                 # There are more error codes but if they happen then something
                 # serious has gone wrong-- carry on error-ing.
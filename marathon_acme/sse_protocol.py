@@ -1,78 +1,214 @@
-from twisted.internet.defer import Deferred
+from collections import deque
+
+from twisted.internet.defer import Deferred, maybeDeferred
 from twisted.internet.protocol import connectionDone, Protocol
 from twisted.logger import Logger, LogLevel
+from twisted.protocols.policies import TimeoutMixin
 
 
-class SseProtocol(Protocol):
+class SseProtocol(Protocol, TimeoutMixin):
     """
     A protocol for Server-Sent Events (SSE).
     https://html.spec.whatwg.org/multipage/comms.html#server-sent-events
+
+    The ``last_event_id`` and ``retry`` attributes hold the ID of the last
+    event received and the reconnection time in milliseconds advertised by
+    the server, or None if the server has not sent them.
+
+    Events are delivered to the handler one at a time: if the handler returns
+    a Deferred, the next event is only delivered once it has fired. Events
+    received in the meantime are queued and, once ``MAX_PENDING_EVENTS`` are
+    queued, the transport is paused until the queue has drained.
     """
 
-    MAX_LENGTH = 1024 * 1024 * 1024  # 1MiB
+    MAX_LENGTH = 1024 * 1024  # 1MiB
+    MAX_EVENT_LENGTH = 1024 * 1024  # 1MiB
+    MAX_PENDING_EVENTS = 100
     log = Logger()
 
-    def __init__(self, handler):
+    def __init__(self, handler, event_types=None, timeout=None, reactor=None):
         """
         :param handler:
             A 2-args callable that will be called back with the event and data
-            when a complete message is received.
+            when a complete message is received. It may return a Deferred to
+            delay delivery of the following events.
+        :param event_types:
+            The collection of event types that the handler is interested in.
+            Events of any other type are dropped without their data being
+            collected or decoded. If None, all events are delivered. The
+            ``event`` field of an event should come before its ``data``
+            fields, as Marathon sends them: once data has been dropped for an
+            unwanted type, the event is not delivered even if a later
+            ``event`` field gives it a wanted type.
+        :param timeout:
+            The number of seconds that the connection may be idle (i.e. no
+            bytes at all received, including comments) before the connection
+            is closed. If None, the connection may be idle indefinitely.
+        :param reactor:
+            The reactor to use for the idle timeout. If None, the global
+            reactor is used.
         """
         self._handler = handler
+        self._event_types = (
+            frozenset(event_types) if event_types is not None else None)
         self._waiting = []
-        self._buffer = b''
+        self._buffer = bytearray()
+        self._skip_lf = False
+        self._discarding_line = False
+
+        self.discarded_events = 0
+        self.last_event_id = None
+        self.retry = None
+        self._last_event_id_buffer = None
+
+        self._pending = deque()
+        self._delivering = False
+        self._paused = False
+        self._finished = False
+
+        self._timeout = timeout
+        if reactor is not None:
+            self.callLater = reactor.callLater
 
         self._reset_event_data()
 
     def _reset_event_data(self):
         self._event = 'message'
         self._data_lines = []
+        self._data_length = 0
+        self._discarding = False
+        self._data_dropped = False
+        self._oversized = False
+
+    @property
+    def queue_depth(self):
+        """
+        The number of events that have been received but not yet handled,
+        including any event that the handler is busy with.
+        """
+        return len(self._pending) + (1 if self._delivering else 0)
 
     def when_finished(self):
         """
-        Get a deferred that will be fired when the connection is closed.
+        Get a deferred that will be fired when the connection is closed and
+        all the events received have been handled.
         """
         d = Deferred()
         self._waiting.append(d)
         return d
 
+    def connectionMade(self):
+        self.setTimeout(self._timeout)
+
+    def timeoutConnection(self):
+        self.log.warn('SSE connection idle for more than {timeout} seconds, '
+                      'closing connection', timeout=self._timeout)
+        self.transport.loseConnection()
+
     def dataReceived(self, data):
         """
         Translates bytes into lines, and calls lineReceived.
 
-        Copied from ``twisted.protocols.basic.LineOnlyReceiver`` but using
-        str.splitlines() to split on ``\r\n``, ``\n``, and ``\r``.
+        Lines may be terminated by ``\r\n``, ``\n``, or ``\r``. Incomplete
+        lines are kept in a buffer between calls and only the newly received
+        bytes are scanned for line terminators, so a line that arrives in many
+        small chunks is not re-scanned for each chunk.
+
+        Lines longer than ``MAX_LENGTH`` are not buffered beyond that length:
+        the line and the event it is part of are discarded, but the connection
+        is kept open.
         """
-        lines = (self._buffer + data).splitlines()
+        self.resetTimeout()
+
+        if self._skip_lf:
+            # The previous chunk ended with a '\r' that may have been the first
+            # half of a '\r\n' line terminator.
+            self._skip_lf = False
+            if data[:1] == b'\n':
+                data = data[1:]
 
-        # str.splitlines() doesn't split the string after a trailing newline
-        # character so we must check if there is a trailing newline and, if so,
-        # clear the buffer as the line is "complete". Else, the line is
-        # incomplete and we keep the last line in the buffer.
-        if data.endswith(b'\n') or data.endswith(b'\r'):
-            self._buffer = b''
-        else:
-            self._buffer = lines.pop(-1)
+        buf = self._buffer
+        # The buffered bytes are known not to contain a line terminator
+        scan_pos = len(buf)
+        buf.extend(data)
 
-        for line in lines:
+        # Track the next '\r' and '\n' separately so that each is searched
+        # for with a fast find() and no byte is scanned more than once.
+        next_cr = buf.find(b'\r', scan_pos)
+        next_lf = buf.find(b'\n', scan_pos)
+        line_start = 0
+        while next_cr != -1 or next_lf != -1:
             if self.transport.disconnecting:
                 # this is necessary because the transport may be told to lose
                 # the connection by a line within a larger packet, and it is
                 # important to disregard all the lines in that packet following
                 # the one that told it to close.
                 return
-            if len(line) > self.MAX_LENGTH:
-                self.lineLengthExceeded(line)
-                return
+
+            if next_lf == -1 or (next_cr != -1 and next_cr < next_lf):
+                line_end = next_cr
+                scan_pos = next_cr + 1
+                if next_lf == scan_pos:
+                    # Consume the '\n' of a '\r\n' terminator too
+                    scan_pos += 1
             else:
-                self.lineReceived(line)
-        if len(self._buffer) > self.MAX_LENGTH:
-            self.lineLengthExceeded(self._buffer)
-            return
+                line_end = next_lf
+                scan_pos = next_lf + 1
 
-    def lineReceived(self, line):
-        line = line.decode('utf-8')
+            if self._discarding_line:
+                # This is the end of a line that was too long, the start of
+                # which has already been discarded.
+                self._discarding_line = False
+            elif line_end - line_start > self.MAX_LENGTH:
+                self.lineLengthExceeded(buf[line_start:line_end])
+            elif line_end > line_start and self._skip_line(buf, line_start):
+                # The line belongs to an event that is being dropped and can't
+                # change that, so don't bother copying it out.
+                pass
+            else:
+                # Slicing the buffer copies the line out of it exactly once
+                self.lineReceived(buf[line_start:line_end])
+            line_start = scan_pos
+
+            if next_cr != -1 and next_cr < scan_pos:
+                next_cr = buf.find(b'\r', scan_pos)
+            if next_lf != -1 and next_lf < scan_pos:
+                next_lf = buf.find(b'\n', scan_pos)
+
+        if line_start > 0:
+            # A '\r' at the very end of the data may be followed by a '\n' in
+            # the next chunk that belongs to the same line terminator.
+            self._skip_lf = (line_start == len(buf) and
+                             buf[line_start - 1:line_start] == b'\r')
+            del buf[:line_start]
 
+        if self._discarding_line:
+            del buf[:]
+        elif len(buf) > self.MAX_LENGTH:
+            self.lineLengthExceeded(buf)
+            # Drop what we have of the line and skip the rest of it as it is
+            # received
+            del buf[:]
+            self._discarding_line = True
+
+    def _skip_line(self, buf, line_start):
+        """
+        Check whether the (non-empty) line starting at the given position in
+        the buffer can be skipped without parsing it.
+        """
+        if not (self._discarding or self._oversized):
+            return False
+        # Only lines that could change the event type, the ID or the
+        # reconnection time are still needed
+        if (buf.startswith(b'event', line_start) or
+                buf.startswith(b'id', line_start) or
+                buf.startswith(b'retry', line_start)):
+            return False
+        if buf.startswith(b'data', line_start):
+            self._data_dropped = True
+        return True
+
+    def lineReceived(self, line):
         if not line:
             self._dispatch_event()
             return
@@ -81,47 +217,155 @@ class SseProtocol(Protocol):
         self._handle_field_value(field, value)
 
     def lineLengthExceeded(self, line):
-        self.log.error('SSE maximum line length exceeded: {length} > {max}',
-                       length=len(line), max=self.MAX_LENGTH)
-        self.transport.loseConnection()
+        if self._discarding:
+            # The event is being dropped anyway
+            return
+
+        self.log.warn(
+            'SSE maximum line length exceeded: {length} > {max}, discarding '
+            'event', length=len(line), max=self.MAX_LENGTH)
+        self._discard_event()
+
+    def _discard_event(self):
+        """
+        Discard the event currently being received because it is too large.
+        Any further data for the event is ignored until the event is complete.
+        """
+        self._oversized = True
+        self._data_lines = []
+        self._data_length = 0
 
     def _handle_field_value(self, field, value):
         """ Handle the field, value pair. """
-        if field == 'event':
-            self._event = value
-        elif field == 'data':
-            self._data_lines.append(value)
-        elif field == 'id':
-            # Not implemented
-            pass
-        elif field == 'retry':
-            # Not implemented
-            pass
+        if field == b'event':
+            self._event = value.decode('utf-8')
+            if self._is_wanted(self._event):
+                # Data that was dropped while the event type was unwanted
+                # can't be recovered, so the event can't be delivered
+                self._discarding = self._data_dropped
+            else:
+                self._discarding = True
+                self._data_dropped = self._data_dropped or bool(
+                    self._data_lines)
+                self._data_lines = []
+                self._data_length = 0
+        elif field == b'data':
+            if self._discarding:
+                self._data_dropped = True
+                return
+            if self._oversized:
+                return
+
+            # Count the newline that will be added between lines too
+            self._data_length += len(value) + 1
+            if self._data_length > self.MAX_EVENT_LENGTH:
+                self.log.warn(
+                    'SSE maximum event length exceeded: {length} > {max}, '
+                    'discarding event', length=self._data_length,
+                    max=self.MAX_EVENT_LENGTH)
+                self._discard_event()
+            else:
+                self._data_lines.append(value)
+        elif field == b'id':
+            if b'\0' not in value:
+                # An empty ID resets the last event ID
+                self._last_event_id_buffer = value.decode('utf-8') or None
+        elif field == b'retry':
+            if value.isdigit():
+                self.retry = int(value)
         # Otherwise, ignore
 
+    def _is_wanted(self, event):
+        return self._event_types is None or event in self._event_types
+
     def _dispatch_event(self):
         """
         Dispatch the event to the handler.
         """
-        data = self._prepare_data()
-        if data is not None:
-            self._handler(self._event, data)
+        self.last_event_id = self._last_event_id_buffer
+
+        if self._oversized:
+            self.discarded_events += 1
+        elif not self._discarding and self._is_wanted(self._event):
+            data = self._prepare_data()
+            if data is not None:
+                self._deliver(self._event, data)
 
         self._reset_event_data()
 
     def _prepare_data(self):
         """
         Join the data lines into a single string for delivery to the callback.
+        The data is decoded from UTF-8 once for the whole event.
         """
         # If the data is empty, abort
         if not self._data_lines:
             return None
 
-        # Add a newline character between lines
-        return '\n'.join(self._data_lines)
+        # Add a newline character between lines. The lines are bytearrays,
+        # which only a bytearray can join on Python 2.
+        return bytearray(b'\n').join(self._data_lines).decode('utf-8')
+
+    def _deliver(self, event, data):
+        """
+        Queue an event for delivery to the handler, pausing the transport if
+        the queue is full.
+        """
+        self._pending.append((event, data))
+        if not self._paused and len(self._pending) >= self.MAX_PENDING_EVENTS:
+            self.log.warn('SSE event queue full ({depth} events), pausing '
+                          'connection', depth=self.queue_depth)
+            self._paused = True
+            self.transport.pauseProducing()
+            # The connection is idle because we paused it, not the server
+            self.setTimeout(None)
+
+        if not self._delivering:
+            self._deliver_pending()
+
+    def _deliver_pending(self):
+        """
+        Deliver queued events to the handler until the queue is empty or the
+        handler returns a Deferred that hasn't fired yet.
+        """
+        self._delivering = True
+        while self._pending:
+            event, data = self._pending.popleft()
+            d = maybeDeferred(self._handler, event, data)
+            d.addErrback(self._handler_failed, event)
+
+            handled = []
+            d.addCallback(handled.append)
+            if not handled:
+                d.addCallback(lambda _: self._deliver_pending())
+                self._maybe_resume()
+                return
+        self._delivering = False
+
+        self._maybe_resume()
+        if self._finished:
+            self._fire_finished()
+
+    def _handler_failed(self, failure, event):
+        self.log.failure(
+            'Error handling SSE event "{event}"', failure, event=event)
+
+    def _maybe_resume(self):
+        if self._paused and not self._pending:
+            self._paused = False
+            if not self._finished:
+                self.log.info('SSE event queue drained, resuming connection')
+                self.transport.resumeProducing()
+                self.setTimeout(self._timeout)
 
     def connectionLost(self, reason=connectionDone):
+        self.setTimeout(None)
         self.log.failure('SSE connection lost', reason, LogLevel.warn)
+        self._finished = True
+        if not self._delivering:
+            self._fire_finished()
+
+    def _fire_finished(self):
         for d in list(self._waiting):
             d.callback(None)
         self._waiting = []
@@ -129,18 +373,19 @@ class SseProtocol(Protocol):
 
 def _parse_field_value(line):
     """ Parse the field and value from a line. """
-    if line.startswith(':'):
+    if line.startswith(b':'):
         # Ignore the line
         return None, None
 
-    if ':' not in line:
+    index = line.find(b':')
+    if index == -1:
         # Treat the entire line as the field, use empty string as value
-        return line, ''
-
-    # Else field is before the ':' and value is after
-    field, value = line.split(':', 1)
+        return line, b''
 
-    # If value starts with a space, remove it.
-    value = value[1:] if value.startswith(' ') else value
+    # Else field is before the ':' and value is after. If value starts with a
+    # space, remove it.
+    value_start = index + 1
+    if line[value_start:value_start + 1] == b' ':
+        value_start += 1
 
-    return field, value
+    return line[:index], line[value_start:]
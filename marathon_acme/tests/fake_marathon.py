@@ -4,7 +4,7 @@ from datetime import datetime
 from klein import Klein
 from treq.testing import StubTreq
 
-from marathon_acme.clients import get_single_header
+from marathon_acme.clients import get_single_header, label_matches
 from marathon_acme.server import write_request_json
 
 
@@ -17,9 +17,10 @@ def marathon_timestamp(time=datetime.utcnow()):
 
 
 class FakeMarathon(object):
-    def __init__(self):
+    def __init__(self, leader='localhost:8080'):
         self._apps = {}
         self.event_callbacks = []
+        self.leader = leader
 
     def add_app(self, app, client_ip=None):
         # Store the app
@@ -32,8 +33,82 @@ class FakeMarathon(object):
                            uri='/v2/apps/' + app_id.lstrip('/'),
                            appDefinition=app)
 
-    def get_apps(self):
-        return list(self._apps.values())
+    def remove_app(self, app_id):
+        del self._apps[app_id]
+
+        self.trigger_event('app_terminated_event', appId=app_id)
+
+    def deploy_apps(self, apps, pod_ids=(), version=None):
+        """
+        Add or update apps in a single deployment, like a group deployment,
+        without an ``api_post_event`` per app. The deployment can also start
+        pods, which are otherwise ignored.
+
+        :param version:
+            The version of the deployment plan, which Marathon also gives the
+            apps that the deployment changes. If None, the plan has no
+            version.
+        """
+        actions = [{'action': 'StartPod', 'pod': pod_id} for pod_id in pod_ids]
+        for app in apps:
+            action = ('RestartApplication' if app['id'] in self._apps
+                      else 'StartApplication')
+            actions.append({'action': action, 'app': app['id']})
+            self._apps[app['id']] = app
+
+        self._trigger_deployment(actions, version)
+
+    def scale_apps(self, instances):
+        """
+        Scale apps in a single deployment.
+
+        :param instances: A dict of app IDs to their new number of instances.
+        """
+        actions = []
+        for app_id, count in sorted(instances.items()):
+            self._apps[app_id] = dict(self._apps[app_id], instances=count)
+            actions.append({'action': 'ScaleApplication', 'app': app_id})
+
+        self._trigger_deployment(actions)
+
+    def _trigger_deployment(self, actions, version=None):
+        plan = {'steps': [{'actions': actions}]}
+        if version is not None:
+            plan['version'] = version
+        self.trigger_event('deployment_success',
+                           id='97c136bf-5a28-4821-9d94-480d9fbb01c8',
+                           plan=plan)
+
+    def get_apps(self, label=None):
+        return [app for app in self._apps.values()
+                if label is None or label_matches(label, app['labels'])]
+
+    def get_group(self, group_id):
+        """
+        Get a group with its apps and nested groups, built from the IDs of
+        the apps. Returns None if there are no apps in the group.
+        """
+        prefix = group_id.rstrip('/') + '/'
+        apps, groups = [], {}
+        for app_id, app in sorted(self._apps.items()):
+            if not app_id.startswith(prefix):
+                continue
+            nested, sep, _ = app_id[len(prefix):].partition('/')
+            if sep:
+                groups[prefix + nested] = None
+            else:
+                apps.append(app)
+
+        if not apps and not groups:
+            return None
+        return {
+            'id': group_id.rstrip('/') or '/',
+            'apps': apps,
+            'groups': [self.get_group(g) for g in sorted(groups)],
+        }
+
+    def get_app(self, app_id):
+        return self._apps.get(app_id)
 
     def attach_event_stream(self, callback, remote_address=None):
         assert callback not in self.event_callbacks
@@ -63,26 +138,76 @@ class FakeMarathon(object):
 class FakeMarathonAPI(object):
     app = Klein()
 
-    def __init__(self, marathon):
+    def __init__(self, marathon, event_ids=False, event_stream_retry=None):
+        """
+        :param marathon: The ``FakeMarathon`` to serve.
+        :param event_ids:
+            Whether to send an ID with each event on the event stream.
+        :param event_stream_retry:
+            A reconnection time in milliseconds to advertise on the event
+            stream, or None.
+        """
         self._marathon = marathon
         self.client = StubTreq(self.app.resource())
         self.event_requests = []
         self._called_get_apps = False
+        self._called_get_app = False
+        self._event_ids = event_ids
+        self._event_stream_retry = event_stream_retry
+        self._next_event_id = 1
 
     def check_called_get_apps(self):
         """ Check and reset the ``_called_get_apps`` flag. """
         was_called, self._called_get_apps = self._called_get_apps, False
         return was_called
 
+    def check_called_get_app(self):
+        """ Check and reset the ``_called_get_app`` flag. """
+        was_called, self._called_get_app = self._called_get_app, False
+        return was_called
+
     @app.route('/v2/apps', methods=['GET'])
     def get_apps(self, request):
         self._called_get_apps = True
+        label = request.args.get(b'label')
         response = {
-            'apps': self._marathon.get_apps()
+            'apps': self._marathon.get_apps(
+                label[0].decode('utf-8') if label else None)
         }
         request.setResponseCode(200)
         write_request_json(request, response)
 
+    @app.route('/v2/apps/<path:app_id>', methods=['GET'])
+    def get_app(self, request, app_id):
+        self._called_get_app = True
+        app = self._marathon.get_app('/' + app_id)
+        if app is None:
+            request.setResponseCode(404)
+            write_request_json(request, {
+                'message': "App '/%s' does not exist" % (app_id,)})
+            return
+
+        request.setResponseCode(200)
+        write_request_json(request, {'app': app})
+
+    @app.route('/v2/groups/<path:group_id>', methods=['GET'])
+    def get_group(self, request, group_id):
+        self._called_get_apps = True
+        group = self._marathon.get_group('/' + group_id)
+        if group is None:
+            request.setResponseCode(404)
+            write_request_json(request, {
+                'message': "Group '/%s' does not exist" % (group_id,)})
+            return
+
+        request.setResponseCode(200)
+        write_request_json(request, group)
+
+    @app.route('/v2/leader', methods=['GET'])
+    def get_leader(self, request):
+        request.setResponseCode(200)
+        write_request_json(request, {'leader': self._marathon.leader})
+
     @app.route('/v2/events', methods=['GET'])
     def get_events(self, request):
         assert (get_single_header(request.requestHeaders, 'Accept') ==
@@ -91,12 +216,31 @@ class FakeMarathonAPI(object):
         request.setResponseCode(200)
         request.setHeader('Content-Type', 'text/event-stream')
 
+        # Filter the event stream if any event types were requested
+        event_types = [
+            t.decode('utf-8') for t in request.args.get(b'event_type', [])]
+
+        if self._event_stream_retry is not None:
+            request.write(b'retry: %d\n\n' % (self._event_stream_retry,))
+
         def callback(event):
-            _write_request_event(request, event)
+            event_id = None
+            if self._event_ids:
+                event_id, self._next_event_id = (
+                    self._next_event_id, self._next_event_id + 1)
+
+            if event_types and event['eventType'] not in event_types:
+                return
+            _write_request_event(request, event, event_id)
             self.client.flush()
         self._marathon.attach_event_stream(callback, request.getClientIP())
         self.event_requests.append(request)
 
+        # Make sure the response headers are sent even if the attach event was
+        # filtered out of the stream
+        request.write(b'')
+        self.client.flush()
+
         def finished_errback(failure):
             self._marathon.detach_event_stream(callback, request.getClientIP())
             self.event_requests.remove(request)
@@ -107,8 +251,10 @@ class FakeMarathonAPI(object):
         return finished
 
 
-def _write_request_event(request, event):
+def _write_request_event(request, event, event_id=None):
     event_type = event['eventType']
+    if event_id is not None:
+        request.write(b'id: %d\n' % (event_id,))
     request.write(b'event: %s\n' % (event_type.encode('utf-8'),))
     request.write(b'data: %s\n' % (json.dumps(event).encode('utf-8'),))
     request.write(b'\n')
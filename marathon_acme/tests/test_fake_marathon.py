@@ -98,6 +98,94 @@ class TestFakeMarathonAPI(object):
         # Checking the flag should reset it to False
         assert_that(self.marathon_api.check_called_get_apps(), Equals(False))
 
+    def test_get_apps_label(self):
+        """
+        When the list of apps is requested with a label selector, only the
+        apps with matching labels should be returned.
+        """
+        app1 = {'id': '/my-app_1', 'labels': {'HAPROXY_GROUP': 'external'}}
+        app2 = {'id': '/my-app_2', 'labels': {'HAPROXY_GROUP': 'internal'}}
+        app3 = {'id': '/my-app_3', 'labels': {}}
+        for app in [app1, app2, app3]:
+            self.marathon.add_app(app)
+
+        response = self.client.get(
+            'http://localhost/v2/apps?label=HAPROXY_GROUP==external')
+        assert_that(response, succeeded(MatchesAll(
+            IsJsonResponseWithCode(200),
+            After(json_content, succeeded(Equals({'apps': [app1]})))
+        )))
+
+    def test_get_group(self):
+        """
+        When a group is requested, the group should be returned with its apps
+        and nested groups.
+        """
+        app1 = {'id': '/my-group/my-app_1', 'labels': {}}
+        app2 = {'id': '/my-group/nested/my-app_2', 'labels': {}}
+        app3 = {'id': '/other-app', 'labels': {}}
+        for app in [app1, app2, app3]:
+            self.marathon.add_app(app)
+
+        response = self.client.get('http://localhost/v2/groups/my-group')
+        assert_that(response, succeeded(MatchesAll(
+            IsJsonResponseWithCode(200),
+            After(json_content, succeeded(Equals({
+                'id': '/my-group',
+                'apps': [app1],
+                'groups': [{
+                    'id': '/my-group/nested',
+                    'apps': [app2],
+                    'groups': [],
+                }],
+            })))
+        )))
+
+    def test_get_app(self):
+        """
+        When a single app is requested, the app definition added via add_app()
+        should be returned.
+        """
+        app = {
+            'id': '/my-group/my-app_1',
+            'cmd': 'sleep 50',
+            'tasks': []
+        }
+        self.marathon.add_app(app)
+
+        response = self.client.get(
+            'http://localhost/v2/apps/my-group/my-app_1')
+        assert_that(response, succeeded(MatchesAll(
+            IsJsonResponseWithCode(200),
+            After(json_content, succeeded(Equals({'app': app})))
+        )))
+
+    def test_get_leader(self):
+        """
+        When the leader is requested, the address of the leader should be
+        returned.
+        """
+        self.marathon.leader = 'marathon2.example.com:8080'
+
+        response = self.client.get('http://localhost/v2/leader')
+        assert_that(response, succeeded(MatchesAll(
+            IsJsonResponseWithCode(200),
+            After(json_content, succeeded(Equals(
+                {'leader': 'marathon2.example.com:8080'})))
+        )))
+
+    def test_get_app_not_found(self):
+        """
+        When a single app is requested that does not exist, a 404 response
+        should be returned.
+        """
+        response = self.client.get('http://localhost/v2/apps/my-app_1')
+        assert_that(response, succeeded(MatchesAll(
+            IsJsonResponseWithCode(404),
+            After(json_content, succeeded(Equals({
+                'message': "App '/my-app_1' does not exist"})))
+        )))
+
     def test_get_events(self):
         """
         When a request is made to the event stream endpoint, an SSE stream
@@ -227,6 +315,42 @@ class TestFakeMarathonAPI(object):
                         appDefinition=Equals(app)))
                 ]))))
 
+    def test_get_events_event_type_filter(self):
+        """
+        When a request is made to the event stream endpoint with the
+        ``event_type`` query parameter, only events of that type should be
+        received.
+        """
+        response = self.client.get(
+            'http://localhost/v2/events?event_type=api_post_event', headers={
+                'Accept': 'text/event-stream'
+            })
+        assert_that(response, succeeded(IsSseResponse()))
+
+        attach_data = []
+        post_data = []
+        sse_content(response.result, dict_handler({
+            'event_stream_attached': attach_data.append,
+            'api_post_event': post_data.append
+        }))
+
+        self.marathon.add_app({
+            'id': '/my-app_1',
+            'labels': {},
+            'portDefinitions': []
+        })
+
+        assert_that(attach_data, Equals([]))
+        assert_that(post_data, MatchesListwise([
+            After(json.loads, IsMarathonEvent(
+                'api_post_event', clientIp=Is(None),
+                uri=Equals('/v2/apps/my-app_1'), appDefinition=Equals({
+                    'id': '/my-app_1',
+                    'labels': {},
+                    'portDefinitions': []
+                })))
+        ]))
+
 
 class TestFakeMarathonLb(object):
 
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+from testtools.assertions import assert_that
+from testtools.matchers import Equals, IsInstance
+
+from marathon_acme import json_codec
+
+CODECS = [(json_codec._stdlib_loads, json_codec._stdlib_dumps)]
+if json_codec.orjson is not None:
+    CODECS.append((json_codec.orjson.loads, json_codec.orjson.dumps))
+
+DOCUMENT = {
+    'apps': [
+        {
+            'id': u'/app-☃',
+            'labels': {'HAPROXY_0_VHOST': 'example.com', 'A': 'x\\"y'},
+            'instances': 2,
+            'cpus': 0.25,
+            'cmd': None,
+            'healthChecks': [],
+            'requirePorts': False,
+        },
+    ],
+}
+
+
+class TestJsonCodec(object):
+    def test_backend(self):
+        """
+        The orjson backend should be used when orjson is installed, otherwise
+        the standard library's json module should be used.
+        """
+        if json_codec.orjson is not None:
+            assert_that(json_codec.backend, Equals('orjson'))
+        else:
+            assert_that(json_codec.backend, Equals('json'))
+
+    @pytest.mark.parametrize('loads,dumps', CODECS)
+    def test_dumps(self, loads, dumps):
+        """
+        When an object is encoded, the result should be UTF-8 bytes that the
+        standard library decodes to an equal object.
+        """
+        data = dumps(DOCUMENT)
+        assert_that(data, IsInstance(bytes))
+        assert_that(json.loads(data.decode('utf-8')), Equals(DOCUMENT))
+
+    @pytest.mark.parametrize('loads,dumps', CODECS)
+    def test_loads_bytes(self, loads, dumps):
+        """
+        When UTF-8 bytes are decoded, the result should be the same as the
+        standard library's.
+        """
+        data = json.dumps(DOCUMENT).encode('utf-8')
+        assert_that(loads(data), Equals(DOCUMENT))
+
+    @pytest.mark.parametrize('loads,dumps', CODECS)
+    def test_loads_text(self, loads, dumps):
+        """
+        When text is decoded, the result should be the same as the standard
+        library's.
+        """
+        assert_that(loads(json.dumps(DOCUMENT)), Equals(DOCUMENT))
+
+    @pytest.mark.parametrize('loads,dumps', CODECS)
+    def test_loads_invalid(self, loads, dumps):
+        """
+        When an invalid document is decoded, a ValueError should be raised.
+        """
+        with pytest.raises(ValueError):
+            loads(b'{"apps": [')
+        with pytest.raises(ValueError):
+            loads(b'"\xff"')
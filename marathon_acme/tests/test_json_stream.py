@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+from testtools.assertions import assert_that
+from testtools.matchers import Equals, Is, IsInstance, MatchesStructure
+from testtools.twistedsupport import failed, succeeded
+from twisted.python.failure import Failure
+from twisted.web.client import ResponseDone, ResponseFailed
+
+from marathon_acme.json_stream import JsonFieldItemsProtocol
+
+
+class DummyTransport(object):
+    stopped = False
+
+    def stopProducing(self):
+        self.stopped = True
+
+
+class TestJsonFieldItemsProtocol(object):
+    def setup_method(self):
+        self.items = []
+        self.protocol = JsonFieldItemsProtocol('apps', self.items.append)
+        self.transport = DummyTransport()
+        self.protocol.makeConnection(self.transport)
+        self.finished = self.protocol.when_finished()
+
+    def finish(self, reason=None):
+        if reason is None:
+            reason = ResponseDone()
+        self.protocol.connectionLost(Failure(reason))
+
+    def test_items(self):
+        """
+        When a JSON object is received with the field holding an array, the
+        handler should be called with each item in the array and the finished
+        deferred should fire with None.
+        """
+        self.protocol.dataReceived(
+            b'{"apps": [{"id": "/app1"}, {"id": "/app2"}, 3, "four"]}')
+        self.finish()
+
+        assert_that(self.items, Equals(
+            [{'id': '/app1'}, {'id': '/app2'}, 3, 'four']))
+        assert_that(self.finished, succeeded(Is(None)))
+
+    def test_items_as_received(self):
+        """
+        When an array item is complete, the handler should be called with the
+        item before the rest of the document has been received.
+        """
+        self.protocol.dataReceived(b'{"apps": [{"id": "/app1"}, {"id": ')
+        assert_that(self.items, Equals([{'id': '/app1'}]))
+
+        self.protocol.dataReceived(b'"/app2"}]}')
+        assert_that(self.items, Equals([{'id': '/app1'}, {'id': '/app2'}]))
+
+    def test_items_as_received_before_next_item(self):
+        """
+        When array items are complete and the text ends after the comma
+        following them, the handler should be called with the items before
+        the next item has started to be received.
+        """
+        self.protocol.dataReceived(b'{"apps": [{"id": "/app1"}, [2], ')
+        assert_that(self.items, Equals([{'id': '/app1'}, [2]]))
+
+    def test_byte_at_a_time(self):
+        """
+        When the document is received a byte at a time, the items should be
+        parsed exactly as if the document had been received in one chunk.
+        """
+        apps = [
+            {'id': '/app1', 'labels': {'A': 'x\\"y', 'B': '[{,:}]'}},
+            {'id': u'/app2-☃', 'ports': [1, 2], 'cmd': None}
+        ]
+        data = json.dumps({'version': '1', 'apps': apps}).encode('utf-8')
+        for i in range(len(data)):
+            self.protocol.dataReceived(data[i:i + 1])
+        self.finish()
+
+        assert_that(self.items, Equals(apps))
+        assert_that(self.finished, succeeded(Is(None)))
+
+    @pytest.mark.parametrize('chunk_size', [1, 7, 64, 4096])
+    def test_strings_with_brackets_chunked(self, chunk_size):
+        """
+        When items have strings holding brackets, quotes and escapes, and the
+        document is received in chunks of any size, the items should be
+        parsed exactly as if the document had been received in one chunk.
+        """
+        apps = [
+            {'id': '/app%d' % (i,), 'labels': {
+                'A': ['}]', '{[', 'x\\"]}', '\\', '"', '],{'][i % 6]},
+             'ports': [i, {'x': []}]}
+            for i in range(30)
+        ]
+        data = json.dumps({'apps': apps}).encode('utf-8')
+        for i in range(0, len(data), chunk_size):
+            self.protocol.dataReceived(data[i:i + chunk_size])
+        self.finish()
+
+        assert_that(self.items, Equals(apps))
+        assert_that(self.finished, succeeded(Is(None)))
+
+    def test_buffer_only_holds_current_item(self):
+        """
+        When items have been handled, their text should not be kept.
+        """
+        self.protocol.dataReceived(b'{"apps": [{"id": "/app1"}, {"id"')
+        assert_that(self.protocol._text, Equals(u'{"id"'))
+
+    def test_other_fields_ignored(self):
+        """
+        When the object has other fields, including nested fields and string
+        values with the same name as the field, only the items in the field's
+        array should be passed to the handler.
+        """
+        self.protocol.dataReceived(
+            b'{"other": {"apps": [1, 2]}, "name": "apps", "list": ["apps"], '
+            b'"apps": [{"apps": [3]}], "more": [4]}')
+        self.finish()
+
+        assert_that(self.items, Equals([{'apps': [3]}]))
+        assert_that(self.finished, succeeded(Is(None)))
+
+    def test_number_items_split(self):
+        """
+        When a number item is split across chunks, the whole number should be
+        passed to the handler.
+        """
+        self.protocol.dataReceived(b'{"apps": [12')
+        self.protocol.dataReceived(b'34, 5]}')
+        self.finish()
+
+        assert_that(self.items, Equals([1234, 5]))
+
+    @pytest.mark.parametrize('chunk_size', [1, 3])
+    def test_number_items_chunked(self, chunk_size):
+        """
+        When a number item with a fraction and exponent is received in small
+        chunks, so that it is split after a digit, the whole number should be
+        passed to the handler.
+        """
+        data = b'{"apps": [1.5e3, -2.25 ,7]}'
+        for i in range(0, len(data), chunk_size):
+            self.protocol.dataReceived(data[i:i + chunk_size])
+        self.finish()
+
+        assert_that(self.items, Equals([1500.0, -2.25, 7]))
+        assert_that(self.finished, succeeded(Is(None)))
+
+    def test_number_item_last(self):
+        """
+        When a number item is the last text received before the document
+        ends, it should be passed to the handler before the document is found
+        to be incomplete.
+        """
+        self.protocol.dataReceived(b'{"apps": [1.5')
+        assert_that(self.items, Equals([]))
+        self.finish()
+
+        assert_that(self.items, Equals([1.5]))
+        assert_that(self.finished, failed(MatchesStructure(
+            value=IsInstance(ValueError))))
+
+    def test_empty_array(self):
+        """
+        When the field holds an empty array, the handler should not be called
+        and the finished deferred should fire with None.
+        """
+        self.protocol.dataReceived(b'{"apps": [ ]}')
+        self.finish()
+
+        assert_that(self.items, Equals([]))
+        assert_that(self.finished, succeeded(Is(None)))
+
+    def test_field_missing(self):
+        """
+        When the object doesn't have the field, the finished deferred should
+        fail with a KeyError.
+        """
+        self.protocol.dataReceived(b'{"app": {"id": "/app1"}}')
+        self.finish()
+
+        assert_that(self.finished, failed(MatchesStructure(
+            value=IsInstance(KeyError))))
+
+    def test_not_an_object(self):
+        """
+        When the document isn't a JSON object, the transport should be stopped
+        and the finished deferred should fail.
+        """
+        self.protocol.dataReceived(b'[{"apps": []}]')
+        assert_that(self.transport.stopped, Equals(True))
+        self.finish(ResponseFailed([]))
+
+        assert_that(self.finished, failed(MatchesStructure(
+            value=IsInstance(ValueError))))
+
+    def test_invalid_item(self):
+        """
+        When an item isn't valid JSON, the finished deferred should fail. An
+        invalid item can't be told apart from an incomplete one until the
+        whole document has been received.
+        """
+        self.protocol.dataReceived(b'{"apps": [{"id": "/app1"}, {"id"}]}')
+        self.finish()
+
+        assert_that(self.items, Equals([{'id': '/app1'}]))
+        assert_that(self.finished, failed(MatchesStructure(
+            value=IsInstance(ValueError))))
+
+    def test_handler_error(self):
+        """
+        When the handler raises an exception, the transport should be stopped
+        and the finished deferred should fail with the exception.
+        """
+        def handler(item):
+            raise KeyError('labels')
+        self.protocol = JsonFieldItemsProtocol('apps', handler)
+        self.protocol.makeConnection(self.transport)
+        self.finished = self.protocol.when_finished()
+
+        self.protocol.dataReceived(b'{"apps": [{"id": "/app1"}]}')
+        assert_that(self.transport.stopped, Equals(True))
+        self.finish(ResponseFailed([]))
+
+        assert_that(self.finished, failed(MatchesStructure(
+            value=IsInstance(KeyError))))
+
+    def test_incomplete_document(self):
+        """
+        When the response finishes before the document is complete, the
+        finished deferred should fail.
+        """
+        self.protocol.dataReceived(b'{"apps": [{"id": "/app1"}')
+        self.finish()
+
+        assert_that(self.finished, failed(MatchesStructure(
+            value=IsInstance(ValueError))))
+
+    def test_connection_failed(self):
+        """
+        When the connection fails before the document is complete, the
+        finished deferred should fail with the reason.
+        """
+        self.protocol.dataReceived(b'{"apps": [')
+        self.finish(ResponseFailed([]))
+
+        assert_that(self.finished, failed(MatchesStructure(
+            value=IsInstance(ResponseFailed))))
@@ -0,0 +1,202 @@
+from testtools.assertions import assert_that
+from testtools.matchers import Equals, HasLength, MatchesStructure
+from twisted.internet.address import IPv4Address
+from twisted.internet.interfaces import IHostnameResolver
+from twisted.internet.task import Clock
+from zope.interface import implementer
+
+from marathon_acme.resolver import CachingHostnameResolver
+
+
+@implementer(IHostnameResolver)
+class FakeResolver(object):
+    """
+    A resolver that records resolutions so that tests can complete them.
+    """
+
+    def __init__(self):
+        self.resolutions = []
+
+    def resolveHostName(self, resolutionReceiver, hostName, portNumber=0,
+                        addressTypes=None, transportSemantics='TCP'):
+        self.resolutions.append((resolutionReceiver, hostName, portNumber))
+        resolutionReceiver.resolutionBegan(None)
+
+    def complete(self, *hosts):
+        receiver, _, port = self.resolutions.pop(0)
+        for host in hosts:
+            receiver.addressResolved(IPv4Address('TCP', host, port))
+        receiver.resolutionComplete()
+
+
+class RecordingReceiver(object):
+    def __init__(self):
+        self.resolution = None
+        self.addresses = []
+        self.complete = False
+
+    def resolutionBegan(self, resolution):
+        self.resolution = resolution
+
+    def addressResolved(self, address):
+        self.addresses.append(address)
+
+    def resolutionComplete(self):
+        self.complete = True
+
+    @property
+    def hosts(self):
+        return [address.host for address in self.addresses]
+
+
+class TestCachingHostnameResolver(object):
+    def setup_method(self):
+        self.clock = Clock()
+        self.fake_resolver = FakeResolver()
+        self.resolver = CachingHostnameResolver(
+            self.fake_resolver, self.clock, ttl=60, max_stale=300)
+
+    def resolve(self, host='marathon.mesos', port=8080):
+        receiver = RecordingReceiver()
+        self.resolver.resolveHostName(receiver, host, port)
+        return receiver
+
+    def assert_counts(self, hits, misses, stale):
+        assert_that(self.resolver, MatchesStructure.byEquality(
+            hits=hits, misses=misses, stale=stale))
+
+    def test_miss(self):
+        """
+        When a name is resolved for the first time, it should be resolved by
+        the wrapped resolver and the receiver should get the addresses.
+        """
+        receiver = self.resolve()
+        assert_that(receiver.resolution.name, Equals('marathon.mesos'))
+        assert_that(receiver.complete, Equals(False))
+
+        self.fake_resolver.complete('10.0.0.1', '10.0.0.2')
+        assert_that(receiver.hosts, Equals(['10.0.0.1', '10.0.0.2']))
+        assert_that(receiver.complete, Equals(True))
+        self.assert_counts(hits=0, misses=1, stale=0)
+
+    def test_hit(self):
+        """
+        When a name is resolved again before the TTL has passed, the cached
+        addresses should be given to the receiver straight away.
+        """
+        self.resolve()
+        self.fake_resolver.complete('10.0.0.1')
+
+        self.clock.advance(59)
+        receiver = self.resolve()
+        assert_that(receiver.hosts, Equals(['10.0.0.1']))
+        assert_that(receiver.complete, Equals(True))
+        assert_that(self.fake_resolver.resolutions, HasLength(0))
+        self.assert_counts(hits=1, misses=1, stale=0)
+
+    def test_cached_per_port(self):
+        """
+        Addresses should be cached separately for each port, since the
+        addresses include the port.
+        """
+        self.resolve(port=8080)
+        self.fake_resolver.complete('10.0.0.1')
+
+        receiver = self.resolve(port=9090)
+        assert_that(self.fake_resolver.resolutions, HasLength(1))
+        self.fake_resolver.complete('10.0.0.1')
+        assert_that(receiver.addresses, Equals(
+            [IPv4Address('TCP', '10.0.0.1', 9090)]))
+
+    def test_expired(self):
+        """
+        When a name is resolved again after the TTL has passed, it should be
+        resolved by the wrapped resolver again.
+        """
+        self.resolve()
+        self.fake_resolver.complete('10.0.0.1')
+
+        self.clock.advance(60)
+        receiver = self.resolve()
+        assert_that(receiver.complete, Equals(False))
+        self.fake_resolver.complete('10.0.0.2')
+        assert_that(receiver.hosts, Equals(['10.0.0.2']))
+        self.assert_counts(hits=0, misses=2, stale=0)
+
+    def test_in_flight_shared(self):
+        """
+        When a name is resolved while it is already being resolved, the
+        receivers should share the resolution.
+        """
+        receiver1 = self.resolve()
+        receiver2 = self.resolve()
+        assert_that(self.fake_resolver.resolutions, HasLength(1))
+
+        self.fake_resolver.complete('10.0.0.1')
+        assert_that(receiver1.hosts, Equals(['10.0.0.1']))
+        assert_that(receiver2.hosts, Equals(['10.0.0.1']))
+
+    def test_in_flight_cancelled(self):
+        """
+        When a receiver's resolution is cancelled while the name is being
+        resolved, the addresses should not be delivered to that receiver but
+        should still be delivered to the others and cached.
+        """
+        receiver1 = self.resolve()
+        receiver2 = self.resolve()
+        receiver1.resolution.cancel()
+
+        self.fake_resolver.complete('10.0.0.1')
+        assert_that(receiver1.complete, Equals(False))
+        assert_that(receiver1.addresses, Equals([]))
+        assert_that(receiver2.hosts, Equals(['10.0.0.1']))
+
+        receiver3 = self.resolve()
+        assert_that(receiver3.hosts, Equals(['10.0.0.1']))
+        self.assert_counts(hits=1, misses=2, stale=0)
+
+    def test_cancelled_after_complete(self):
+        """
+        When a receiver's resolution is cancelled after it has completed,
+        nothing should happen.
+        """
+        receiver = self.resolve()
+        self.fake_resolver.complete('10.0.0.1')
+        receiver.resolution.cancel()
+
+        assert_that(receiver.hosts, Equals(['10.0.0.1']))
+        assert_that(receiver.complete, Equals(True))
+
+    def test_failure_stale(self):
+        """
+        When a name can't be resolved again after the TTL has passed, the
+        expired addresses should be used until they are ``max_stale`` seconds
+        past the TTL. After that, the resolution should fail.
+        """
+        self.resolve()
+        self.fake_resolver.complete('10.0.0.1')
+
+        self.clock.advance(359)
+        receiver = self.resolve()
+        self.fake_resolver.complete()
+        assert_that(receiver.hosts, Equals(['10.0.0.1']))
+        self.assert_counts(hits=0, misses=2, stale=1)
+
+        self.clock.advance(1)
+        receiver = self.resolve()
+        self.fake_resolver.complete()
+        assert_that(receiver.hosts, Equals([]))
+        assert_that(receiver.complete, Equals(True))
+        self.assert_counts(hits=0, misses=3, stale=1)
+
+    def test_failure_not_cached(self):
+        """
+        When a name can't be resolved, the failure should not be cached.
+        """
+        self.resolve()
+        self.fake_resolver.complete()
+
+        receiver = self.resolve()
+        assert_that(self.fake_resolver.resolutions, HasLength(1))
+        self.fake_resolver.complete('10.0.0.1')
+        assert_that(receiver.hosts, Equals(['10.0.0.1']))
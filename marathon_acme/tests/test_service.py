@@ -5,20 +5,24 @@ from acme.jose import JWKRSA
 from acme.messages import Error as acme_Error
 from testtools.assertions import assert_that
 from testtools.matchers import (
-    AfterPreprocessing, Equals, HasLength, Is, IsInstance, MatchesAll,
-    MatchesDict, MatchesListwise, MatchesPredicate, MatchesStructure, Not)
+    AfterPreprocessing, Equals, GreaterThan, HasLength, Is, IsInstance,
+    LessThan, MatchesAll, MatchesDict, MatchesListwise, MatchesPredicate,
+    MatchesStructure, Not)
 from testtools.twistedsupport import failed, succeeded
-from twisted.internet.defer import succeed
+from twisted.internet.defer import Deferred, succeed
 from twisted.internet.task import Clock
 from txacme.client import ServerError as txacme_ServerError
 from txacme.testing import FakeClient, MemoryStore
 from txacme.util import generate_private_key
 
-from marathon_acme.clients import MarathonClient, MarathonLbClient
+from marathon_acme.clients import (
+    CountingHTTPConnectionPool, MarathonClient, MarathonLbClient)
+from marathon_acme.resolver import CachingHostnameResolver
 from marathon_acme.service import MarathonAcme, parse_domain_label
 from marathon_acme.tests.fake_marathon import (
     FakeMarathon, FakeMarathonAPI, FakeMarathonLb)
 from marathon_acme.tests.helpers import failing_client
+from marathon_acme.tests.matchers import HasHeader
 
 
 class TestParseDomainLabel(object):
@@ -86,6 +90,37 @@ class FailableTxacmeClient(FakeClient):
         return super(FailableTxacmeClient, self).request_issuance(csr)
 
 
+class DeferredMarathonClient(object):
+    """
+    A stand-in Marathon client whose ``get_apps()`` and ``get_app()`` calls
+    return Deferreds that the test fires, so that syncs can be held in
+    progress.
+    """
+
+    def __init__(self):
+        self.get_apps_requests = []
+        self.get_app_requests = []
+
+    def get_app(self, app_id):
+        d = Deferred()
+        self.get_app_requests.append((app_id, d))
+        return d
+
+    def get_apps(self, label=None, group=None, app_handler=None):
+        d = Deferred()
+        self.get_apps_requests.append(d)
+        if app_handler is None:
+            return d
+
+        def handle_apps(apps):
+            for app in apps:
+                app_handler(app)
+        return d.addCallback(handle_apps)
+
+    def clear_cache(self):
+        pass
+
+
 class TestMarathonAcme(object):
 
     def setup_method(self):
@@ -101,7 +136,7 @@ class TestMarathonAcme(object):
             ['http://localhost:9090'], client=self.fake_marathon_lb.client)
 
         key = JWKRSA(key=generate_private_key(u'rsa'))
-        clock = Clock()
+        self.clock = clock = Clock()
         clock.rightNow = (
             datetime.now() - datetime(1970, 1, 1)).total_seconds()
         self.txacme_client = FailableTxacmeClient(key, clock)
@@ -140,6 +175,43 @@ class TestMarathonAcme(object):
         })))
         assert_that(self.fake_marathon_lb.check_signalled_usr1(), Equals(True))
 
+    def test_listen_events_filtered_event_types(self):
+        """
+        When we listen for events from Marathon, the event stream should be
+        filtered to just the types of events that we handle.
+        """
+        self.marathon_acme.listen_events()
+
+        requests = self.fake_marathon_api.event_requests
+        assert_that(requests, HasLength(1))
+        assert_that(requests[0].args, Equals({
+            b'event_type': [
+                b'api_post_event', b'app_terminated_event',
+                b'deployment_success', b'event_stream_attached'],
+            b'plan-format': [b'light'],
+        }))
+
+    def test_listen_events_attach_discovers_leader(self):
+        """
+        When we listen for events from Marathon and the event stream is
+        attached, the Marathon leader should be discovered so that requests
+        are sent straight to it.
+        """
+        self.fake_marathon.leader = 'localhost:9090'
+        marathon_client = MarathonClient(
+            ['http://localhost:8080', 'http://localhost:9090'],
+            client=self.fake_marathon_api.client)
+        marathon_acme = MarathonAcme(
+            marathon_client, 'external', self.cert_store,
+            MarathonLbClient(['http://localhost:9090'],
+                             client=self.fake_marathon_lb.client),
+            lambda: succeed(self.txacme_client), self.clock)
+
+        marathon_acme.listen_events()
+
+        assert_that(marathon_client._endpoint_order(), Equals(
+            ['http://localhost:9090', 'http://localhost:8080']))
+
     def test_listen_events_attach_only_first(self):
         """
         When we're listening for events and receive multiple
@@ -167,13 +239,15 @@ class TestMarathonAcme(object):
         assert_that(
             self.fake_marathon_api.check_called_get_apps(), Equals(False))
 
-    def test_listen_events_api_request_triggers_sync(self):
+    def test_listen_events_api_request_updates_app(self):
         """
         When we listen for events from Marathon, and something happens that
-        triggers an API request event, a sync should be performed and
-        certificates issued for any new domains.
+        triggers an API request event, certificates should be issued for any
+        new domains of the app in the event without fetching all the apps.
         """
         self.marathon_acme.listen_events()
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(True))
 
         self.fake_marathon.add_app({
             'id': '/my-app_1',
@@ -210,6 +284,246 @@ class TestMarathonAcme(object):
         })))
         assert_that(self.fake_marathon_lb.check_signalled_usr1(), Equals(True))
 
+        # No full sync was needed
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(False))
+
+    def test_listen_events_api_request_unchanged_labels_skipped(self):
+        """
+        When we listen for events from Marathon, and an API request event is
+        received for an app whose group and domain labels and ports haven't
+        changed, the event should be skipped without checking for
+        certificates.
+        """
+        app = {
+            'id': '/my-app_1',
+            'instances': 1,
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com',
+                'SOME_OTHER_LABEL': 'foo',
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        }
+        self.fake_marathon.add_app(app)
+        self.marathon_acme.listen_events()
+        assert_that(self.fake_marathon_lb.check_signalled_usr1(), Equals(True))
+
+        # Record any reads from the certificate store
+        store_reads = []
+        as_dict = self.cert_store.as_dict
+        self.cert_store.as_dict = lambda: store_reads.append(None) or as_dict()
+
+        # Scale the app and change an unrelated label
+        scaled_app = dict(app, instances=3, labels=dict(
+            app['labels'], SOME_OTHER_LABEL='bar'))
+        self.fake_marathon.trigger_event(
+            'api_post_event', clientIp=None, uri='/v2/apps/my-app_1',
+            appDefinition=scaled_app)
+
+        assert_that(store_reads, HasLength(0))
+        assert_that(
+            self.marathon_acme.health().json_message['apps'],
+            Equals({'indexed': 1, 'updates_skipped': 1}))
+
+        # Change the domain label
+        changed_app = dict(app, labels=dict(
+            app['labels'], MARATHON_ACME_0_DOMAIN='example2.com'))
+        self.fake_marathon.trigger_event(
+            'api_post_event', clientIp=None, uri='/v2/apps/my-app_1',
+            appDefinition=changed_app)
+
+        assert_that(store_reads, HasLength(1))
+        assert_that(as_dict(), succeeded(MatchesDict({
+            'example.com': Not(Is(None)),
+            'example2.com': Not(Is(None)),
+        })))
+
+    def test_listen_events_deployment_updates_apps(self):
+        """
+        When we listen for events from Marathon, and a deployment succeeds,
+        the apps in the deployment should be fetched individually and
+        certificates issued for any new domains.
+        """
+        self.marathon_acme.listen_events()
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(True))
+
+        self.fake_marathon.deploy_apps([{
+            'id': '/my-group/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        }])
+
+        assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
+            'example.com': Not(Is(None))
+        })))
+        assert_that(self.fake_marathon_lb.check_signalled_usr1(), Equals(True))
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(False))
+
+    def test_listen_events_deployment_with_pods(self):
+        """
+        When we listen for events from Marathon, and a deployment that
+        includes pods succeeds, the pod actions should be skipped and the apps
+        in the deployment should still be updated.
+        """
+        self.marathon_acme.listen_events()
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(True))
+
+        self.fake_marathon.deploy_apps([{
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        }], pod_ids=['/my-pod'])
+
+        assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
+            'example.com': Not(Is(None))
+        })))
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(False))
+
+    def test_listen_events_deployment_scale_only(self):
+        """
+        When we listen for events from Marathon, and a deployment that only
+        scales apps succeeds, no requests should be made to Marathon as
+        scaling can't change an app's domains.
+        """
+        self.fake_marathon.add_app({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+        self.marathon_acme.listen_events()
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(True))
+
+        self.fake_marathon.scale_apps({'/my-app_1': 3})
+
+        assert_that(
+            self.fake_marathon_api.check_called_get_app(), Equals(False))
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(False))
+
+    def test_listen_events_deployment_after_api_post_event(self):
+        """
+        When we listen for events from Marathon, and a deployment succeeds
+        for an app that was already updated at the deployment's version by an
+        ``api_post_event``, the app should not be fetched again. An app that
+        was updated by a later deployment should be fetched.
+        """
+        app = {
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ],
+            'version': '2017-01-01T00:00:00.000Z',
+        }
+        self.fake_marathon.add_app(app)
+        self.marathon_acme.listen_events()
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(True))
+
+        # Change an unrelated label, which is posted before the deployment
+        updated_app = dict(
+            app, version='2017-01-02T00:00:00.000Z',
+            labels=dict(app['labels'], SOME_OTHER_LABEL='foo'))
+        self.fake_marathon.trigger_event(
+            'api_post_event', clientIp=None, uri='/v2/apps/my-app_1',
+            appDefinition=updated_app)
+        self.fake_marathon.deploy_apps(
+            [updated_app], version='2017-01-02T00:00:00.000Z')
+
+        assert_that(
+            self.fake_marathon_api.check_called_get_app(), Equals(False))
+
+        self.fake_marathon.deploy_apps(
+            [dict(updated_app, version='2017-01-03T00:00:00.000Z')],
+            version='2017-01-03T00:00:00.000Z')
+
+        assert_that(
+            self.fake_marathon_api.check_called_get_app(), Equals(True))
+
+    def test_deployment_app_fetches_bounded(self):
+        """
+        When a deployment updates more apps than the fetch concurrency, only
+        that many apps should be fetched at once.
+        """
+        marathon_acme, _ = self.create_scheduled_marathon_acme()
+        marathon_acme.app_fetch_concurrency = 2
+        get_app_requests = marathon_acme.marathon_client.get_app_requests
+        app_ids = ['/app-%d' % (i,) for i in range(5)]
+
+        marathon_acme._sync_on_deployment_success({
+            'timestamp': '2017-01-01T00:00:00.000Z',
+            'plan': {'steps': [{'actions': [
+                {'action': 'StartApplication', 'app': app_id}
+                for app_id in app_ids]}]},
+        })
+        assert_that(get_app_requests, HasLength(2))
+
+        get_app_requests.pop(0)[1].callback({'id': app_ids[0], 'labels': {}})
+        assert_that(get_app_requests, HasLength(2))
+
+    def test_listen_events_deployment_without_plan(self):
+        """
+        When we listen for events from Marathon, and a deployment succeeds
+        but the event has no deployment plan, a full sync should be performed.
+        """
+        self.marathon_acme.listen_events()
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(True))
+
+        self.fake_marathon.trigger_event('deployment_success', id='abc')
+
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(True))
+
+    def test_listen_events_app_terminated(self):
+        """
+        When we listen for events from Marathon, and an app is terminated, the
+        app should be removed from the index of app domains.
+        """
+        self.fake_marathon.add_app({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+        self.marathon_acme.listen_events()
+        assert_that(self.marathon_acme._app_domains, Equals({
+            '/my-app_1': ['example.com']}))
+
+        self.fake_marathon.remove_app('/my-app_1')
+
+        assert_that(self.marathon_acme._app_domains, Equals({}))
+
     def test_listen_events_reconnects(self):
         """
         When we listen for events, and we connect successfully but the
@@ -274,6 +588,499 @@ class TestMarathonAcme(object):
         assert_that(
             self.fake_marathon_api.check_called_get_apps(), Equals(True))
 
+    def create_marathon_acme(self, fake_marathon_api, **kwargs):
+        """
+        Create a marathon-acme instance that uses the given fake Marathon API
+        and the test clock as its reactor, with any extra keyword arguments.
+        """
+        return MarathonAcme(
+            MarathonClient(['http://localhost:8080'],
+                           client=fake_marathon_api.client,
+                           reactor=self.clock),
+            'external',
+            self.cert_store,
+            MarathonLbClient(['http://localhost:9090'],
+                             client=self.fake_marathon_lb.client),
+            lambda: succeed(self.txacme_client),
+            self.clock,
+            **kwargs
+        )
+
+    def test_sync_app_update_clears_cache(self):
+        """
+        When the Marathon client caches the list of apps, syncs within the
+        cache TTL should reuse the cached list, until an app is updated by an
+        event, after which the next sync should fetch the list again.
+        """
+        marathon_acme = MarathonAcme(
+            MarathonClient(['http://localhost:8080'],
+                           client=self.fake_marathon_api.client,
+                           reactor=self.clock, cache_ttl=60),
+            'external',
+            self.cert_store,
+            MarathonLbClient(['http://localhost:9090'],
+                             client=self.fake_marathon_lb.client),
+            lambda: succeed(self.txacme_client),
+            self.clock
+        )
+        marathon_acme.listen_events()
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(True))
+
+        assert_that(marathon_acme.sync(), succeeded(Equals([])))
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(False))
+
+        self.fake_marathon.add_app({
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        })
+
+        assert_that(marathon_acme.sync(), succeeded(Equals([])))
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(True))
+        assert_that(marathon_acme.health().json_message['apps'],
+                    MatchesDict({'indexed': Equals(1),
+                                 'updates_skipped': Equals(0)}))
+
+    def test_listen_events_idle_timeout_reconnects(self):
+        """
+        When we listen for events with an event stream timeout, and nothing is
+        received on the event stream for longer than the timeout, we should
+        close the connection and reconnect to the event stream.
+        """
+        marathon_acme = self.create_marathon_acme(
+            self.fake_marathon_api, event_stream_timeout=30)
+        marathon_acme.listen_events()
+
+        requests = self.fake_marathon_api.event_requests
+        assert_that(requests, HasLength(1))
+        request = requests[0]
+
+        # Time passes without any events on the stream
+        self.clock.advance(30)
+        self.fake_marathon_api.client.flush()
+
+        # Check a new request has been made
+        requests = self.fake_marathon_api.event_requests
+        assert_that(requests, HasLength(1))
+        assert_that(requests[0], Not(Is(request)))
+
+    def test_listen_events_reconnect_resumes(self):
+        """
+        When we listen for events, and the event stream has event IDs, and
+        the persistent connection drops, we should reconnect with the ID of
+        the last event received and not run another initial sync.
+        """
+        fake_marathon_api = FakeMarathonAPI(
+            self.fake_marathon, event_ids=True)
+        marathon_acme = self.create_marathon_acme(fake_marathon_api)
+        marathon_acme.listen_events()
+
+        # Check the initial sync happens
+        assert_that(fake_marathon_api.check_called_get_apps(), Equals(True))
+
+        # Trigger a lost connection
+        request = fake_marathon_api.event_requests[0]
+        request.loseConnection()
+        fake_marathon_api.client.flush()
+
+        # We reconnect with the last event ID and no sync occurs
+        requests = fake_marathon_api.event_requests
+        assert_that(requests, HasLength(1))
+        assert_that(requests[0].requestHeaders,
+                    HasHeader('Last-Event-ID', ['1']))
+        assert_that(fake_marathon_api.check_called_get_apps(), Equals(False))
+
+    def test_listen_events_reconnect_retry(self):
+        """
+        When we listen for events, and the event stream advertises a retry
+        time, and the persistent connection drops, we should wait for the
+        retry time before reconnecting.
+        """
+        fake_marathon_api = FakeMarathonAPI(
+            self.fake_marathon, event_stream_retry=5000)
+        marathon_acme = self.create_marathon_acme(fake_marathon_api)
+        marathon_acme.listen_events()
+
+        # Trigger a lost connection
+        request = fake_marathon_api.event_requests[0]
+        request.loseConnection()
+        fake_marathon_api.client.flush()
+
+        # No reconnection until the retry time has passed
+        assert_that(fake_marathon_api.event_requests, HasLength(0))
+
+        self.clock.advance(5)
+        fake_marathon_api.client.flush()
+        assert_that(fake_marathon_api.event_requests, HasLength(1))
+
+    def drop_event_stream(self, fake_marathon_api):
+        """
+        Drop the connection to the event stream and return the number of new
+        event stream requests made immediately afterwards.
+        """
+        fake_marathon_api.event_requests[0].loseConnection()
+        fake_marathon_api.client.flush()
+        return len(fake_marathon_api.event_requests)
+
+    def test_listen_events_reconnect_backoff(self):
+        """
+        When we listen for events, and the persistent connection keeps
+        dropping, we should reconnect immediately the first time and then back
+        off exponentially (with jitter) before each following reconnect, up to
+        the maximum delay.
+        """
+        marathon_acme = self.create_marathon_acme(self.fake_marathon_api)
+        marathon_acme.reconnect_delay_max = 4
+        marathon_acme.listen_events()
+
+        # First reconnect is immediate
+        assert_that(self.drop_event_stream(self.fake_marathon_api), Equals(1))
+
+        # Following reconnects wait between half and all of 1s, 2s, 4s, 4s
+        for delay in [1, 2, 4, 4]:
+            assert_that(
+                self.drop_event_stream(self.fake_marathon_api), Equals(0))
+            self.clock.advance(delay / 2.0 - 0.01)
+            self.fake_marathon_api.client.flush()
+            assert_that(self.fake_marathon_api.event_requests, HasLength(0))
+
+            self.clock.advance(delay / 2.0 + 0.01)
+            self.fake_marathon_api.client.flush()
+            assert_that(self.fake_marathon_api.event_requests, HasLength(1))
+
+    def test_listen_events_reconnect_backoff_reset(self):
+        """
+        When we listen for events, and the persistent connection drops after
+        being attached for longer than the reset time, we should reconnect
+        immediately again.
+        """
+        marathon_acme = self.create_marathon_acme(self.fake_marathon_api)
+        marathon_acme.listen_events()
+
+        # Drop twice in quick succession so that we are backing off
+        assert_that(self.drop_event_stream(self.fake_marathon_api), Equals(1))
+        assert_that(self.drop_event_stream(self.fake_marathon_api), Equals(0))
+        self.clock.advance(1)
+        self.fake_marathon_api.client.flush()
+        assert_that(self.fake_marathon_api.event_requests, HasLength(1))
+
+        # Stay attached for the reset time, then drop
+        self.clock.advance(marathon_acme.reconnect_reset_time)
+        assert_that(self.drop_event_stream(self.fake_marathon_api), Equals(1))
+
+    def test_health_event_stream(self):
+        """
+        When the health of the service is checked, it should be healthy and
+        report the state of the event stream and its reconnects.
+        """
+        marathon_acme = self.create_marathon_acme(self.fake_marathon_api)
+        marathon_acme.listen_events()
+
+        assert_that(marathon_acme.health(), MatchesStructure(
+            healthy=Equals(True),
+            json_message=Equals({
+                'event_stream': {
+                    'attached': True,
+                    'reconnects': 0,
+                    'reconnect_attempts': 0,
+                    'reconnect_delay': 0,
+                },
+                'apps': {
+                    'indexed': 0,
+                    'updates_skipped': 0,
+                },
+                'marathon_endpoints': {
+                    'http://localhost:8080': {
+                        'state': 'closed',
+                        'failures': 0,
+                        'total_failures': 0,
+                    },
+                },
+            })))
+
+        self.drop_event_stream(self.fake_marathon_api)
+        self.drop_event_stream(self.fake_marathon_api)
+
+        health = marathon_acme.health()
+        event_stream = health.json_message['event_stream']
+        assert_that(event_stream['attached'], Equals(False))
+        assert_that(event_stream['reconnects'], Equals(1))
+        assert_that(event_stream['reconnect_attempts'], Equals(2))
+        assert_that(event_stream['reconnect_delay'], MatchesAll(
+            GreaterThan(0.49), LessThan(1.01)))
+
+    def test_health_connections(self):
+        """
+        When the service has a connection pool and its health is checked, the
+        connection counts of the pool should be reported.
+        """
+        pool = CountingHTTPConnectionPool(self.clock)
+        pool.requests, pool.connections = 5, 2
+        marathon_acme = self.create_marathon_acme(
+            self.fake_marathon_api, connection_pool=pool)
+
+        assert_that(marathon_acme.health().json_message['connections'],
+                    Equals({'requests': 5, 'opened': 2, 'reused': 3}))
+
+    def test_health_dns_cache(self):
+        """
+        When the service has a caching name resolver and its health is
+        checked, the cache counts of the resolver should be reported.
+        """
+        resolver = CachingHostnameResolver(None, self.clock)
+        resolver.hits, resolver.misses, resolver.stale = 7, 3, 1
+        marathon_acme = self.create_marathon_acme(
+            self.fake_marathon_api, name_resolver=resolver)
+
+        assert_that(marathon_acme.health().json_message['dns_cache'],
+                    Equals({'hits': 7, 'misses': 3, 'stale': 1}))
+
+    def create_scheduled_marathon_acme(self, **kwargs):
+        """
+        Create a marathon-acme instance whose syncs don't complete until the
+        test fires the ``get_apps()`` Deferreds of the returned client.
+        """
+        marathon_client = DeferredMarathonClient()
+        marathon_acme = MarathonAcme(
+            marathon_client,
+            'external',
+            self.cert_store,
+            MarathonLbClient(['http://localhost:9090'],
+                             client=self.fake_marathon_lb.client),
+            lambda: succeed(self.txacme_client),
+            self.clock,
+            **kwargs
+        )
+        return marathon_acme, marathon_client.get_apps_requests
+
+    def test_schedule_sync_coalesced(self):
+        """
+        When syncs are scheduled within the sync delay of each other, a single
+        sync should be run once the delay has passed.
+        """
+        marathon_acme, requests = self.create_scheduled_marathon_acme(
+            sync_delay=5)
+
+        d1 = marathon_acme.schedule_sync()
+        self.clock.advance(2)
+        d2 = marathon_acme.schedule_sync()
+        assert_that(requests, HasLength(0))
+
+        self.clock.advance(3)
+        assert_that(requests, HasLength(1))
+
+        requests[0].callback([])
+        assert_that(d1, succeeded(Is(None)))
+        assert_that(d2, succeeded(Is(None)))
+
+    def test_schedule_sync_single_flight(self):
+        """
+        When syncs are scheduled while a sync is running, a single trailing
+        sync should be run once the running sync has completed.
+        """
+        marathon_acme, requests = self.create_scheduled_marathon_acme()
+
+        d1 = marathon_acme.schedule_sync()
+        assert_that(requests, HasLength(1))
+
+        d2 = marathon_acme.schedule_sync()
+        d3 = marathon_acme.schedule_sync()
+        assert_that(requests, HasLength(1))
+
+        requests[0].callback([])
+        assert_that(d1, succeeded(Is(None)))
+        assert_that(d2.called, Equals(False))
+        assert_that(requests, HasLength(2))
+
+        requests[1].callback([])
+        assert_that(d2, succeeded(Is(None)))
+        assert_that(d3, succeeded(Is(None)))
+        assert_that(requests, HasLength(2))
+
+    def test_schedule_sync_failure(self):
+        """
+        When a scheduled sync fails, the failure should not stop the trailing
+        sync from running.
+        """
+        marathon_acme, requests = self.create_scheduled_marathon_acme()
+
+        d1 = marathon_acme.schedule_sync()
+        d2 = marathon_acme.schedule_sync()
+
+        requests[0].errback(RuntimeError('Something went wrong'))
+        assert_that(d1, succeeded(Is(None)))
+        assert_that(requests, HasLength(2))
+
+        requests[1].callback([])
+        assert_that(d2, succeeded(Is(None)))
+
+    def test_schedule_sync_stale_apps_dropped(self):
+        """
+        When a sync is scheduled while a sync is fetching the apps, the apps
+        fetched by the running sync are stale and should be dropped. The
+        trailing sync should issue certificates for its apps.
+        """
+        marathon_acme, requests = self.create_scheduled_marathon_acme()
+        app = {
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        }
+
+        marathon_acme.schedule_sync()
+        marathon_acme.schedule_sync()
+
+        requests[0].callback([app])
+        assert_that(self.cert_store.as_dict(), succeeded(Equals({})))
+
+        requests[1].callback([app])
+        assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
+            'example.com': Not(Is(None))
+        })))
+
+    def test_sync_keeps_app_updates_during_fetch(self):
+        """
+        When an app is updated by an event while a sync is fetching the apps,
+        the update should not be overwritten by the fetched apps.
+        """
+        marathon_acme, requests = self.create_scheduled_marathon_acme()
+
+        marathon_acme.sync()
+        marathon_acme._sync_on_app_terminated_event({
+            'eventType': 'app_terminated_event',
+            'timestamp': '2017-01-01T00:00:00.000Z',
+            'appId': '/my-app_1',
+        })
+
+        requests[0].callback([{
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        }])
+
+        assert_that(marathon_acme._app_domains, Equals({}))
+        assert_that(self.cert_store.as_dict(), succeeded(Equals({})))
+
+    def test_sync_app_domains_memoized_by_version(self):
+        """
+        When a sync is run, the domains should only be found again for apps
+        whose config version has changed since the last sync, and apps that
+        no longer exist should be dropped from the index.
+        """
+        marathon_acme, requests = self.create_scheduled_marathon_acme()
+        app = {
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ],
+            'version': '2017-01-02T00:00:00.000Z',
+            'versionInfo': {
+                'lastConfigChangeAt': '2017-01-01T00:00:00.000Z'
+            }
+        }
+        other_app = {
+            'id': '/my-app_2',
+            'labels': {},
+            'portDefinitions': [],
+            'version': '2017-01-01T00:00:00.000Z'
+        }
+
+        marathon_acme.sync()
+        requests[0].callback([app, other_app])
+        assert_that(marathon_acme._app_domains, Equals({
+            '/my-app_1': ['example.com'],
+            '/my-app_2': [],
+        }))
+
+        # The app is scaled (the version changes but the config doesn't) and
+        # the other app is removed. As the config version is unchanged, the
+        # previously found domains are used.
+        scaled_app = dict(app, version='2017-01-03T00:00:00.000Z', labels={
+            'HAPROXY_GROUP': 'external',
+            'MARATHON_ACME_0_DOMAIN': 'example2.com'
+        })
+        marathon_acme.sync()
+        requests[1].callback([scaled_app])
+        assert_that(marathon_acme._app_domains, Equals({
+            '/my-app_1': ['example.com'],
+        }))
+
+        # The app config changes
+        changed_app = dict(scaled_app, versionInfo={
+            'lastConfigChangeAt': '2017-01-03T00:00:00.000Z'
+        })
+        marathon_acme.sync()
+        requests[2].callback([changed_app])
+        assert_that(marathon_acme._app_domains, Equals({
+            '/my-app_1': ['example2.com'],
+        }))
+
+    def test_sync_app_label_and_group(self):
+        """
+        When a sync is run and apps are limited to a group and label, only the
+        apps in the group with the label should have certificates issued, and
+        events for apps outside of the group or without the label should be
+        ignored.
+        """
+        marathon_acme = self.create_marathon_acme(
+            self.fake_marathon_api, app_label='HAPROXY_GROUP',
+            app_group='/my-group')
+
+        def app(app_id, domain, haproxy_group=True):
+            labels = {'MARATHON_ACME_0_DOMAIN': domain}
+            if haproxy_group:
+                labels['HAPROXY_GROUP'] = 'external'
+            else:
+                labels['HAPROXY_0_GROUP'] = 'external'
+            return {
+                'id': app_id,
+                'labels': labels,
+                'portDefinitions': [
+                    {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+                ]
+            }
+
+        self.fake_marathon.add_app(app('/my-group/app1', 'example.com'))
+        self.fake_marathon.add_app(app('/other-group/app2', 'example2.com'))
+        self.fake_marathon.add_app(
+            app('/my-group/app3', 'example3.com', haproxy_group=False))
+
+        d = marathon_acme.sync()
+        assert_that(d, succeeded(MatchesListwise([  # Per domain
+            is_marathon_lb_sigusr_response
+        ])))
+        assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
+            'example.com': Not(Is(None))
+        })))
+
+        marathon_acme.listen_events()
+        self.fake_marathon.add_app(app('/other-group/app4', 'example4.com'))
+        assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
+            'example.com': Not(Is(None))
+        })))
+
     def test_sync_app(self):
         """
         When a sync is run and there is an app with a domain label and no
@@ -672,6 +1479,76 @@ class TestMarathonAcme(object):
         assert_that(self.fake_marathon_lb.check_signalled_usr1(),
                     Equals(False))
 
+    def test_sync_acme_server_failure_acceptable_retried(self):
+        """
+        When a sync is run and the ACME server returns an acceptable error
+        for a domain, the next event for the app with the domain should try
+        to issue the certificate again, even if the app is unchanged.
+        """
+        app = {
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        }
+        self.fake_marathon.add_app(app)
+        acme_error = acme_Error(typ='urn:acme:error:rateLimited', detail='bar')
+        self.txacme_client.issuance_error = txacme_ServerError(
+            acme_error, None)
+
+        # The sync when the event stream is attached fails to issue
+        self.marathon_acme.listen_events()
+        assert_that(
+            self.fake_marathon_api.check_called_get_apps(), Equals(True))
+        assert_that(self.cert_store.as_dict(), succeeded(Equals({})))
+
+        self.txacme_client.issuance_error = None
+        self.fake_marathon.trigger_event(
+            'api_post_event', clientIp=None, uri='/v2/apps/my-app_1',
+            appDefinition=app)
+
+        assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
+            'example.com': Not(Is(None))
+        })))
+
+    def test_listen_events_acme_server_failure_acceptable_retried(self):
+        """
+        When we listen for events from Marathon, and the ACME server returns
+        an acceptable error for a domain of an updated app, the next event for
+        the app should try to issue the certificate again, even if the app is
+        unchanged.
+        """
+        self.marathon_acme.listen_events()
+        acme_error = acme_Error(typ='urn:acme:error:rateLimited', detail='bar')
+        self.txacme_client.issuance_error = txacme_ServerError(
+            acme_error, None)
+
+        app = {
+            'id': '/my-app_1',
+            'labels': {
+                'HAPROXY_GROUP': 'external',
+                'MARATHON_ACME_0_DOMAIN': 'example.com'
+            },
+            'portDefinitions': [
+                {'port': 9000, 'protocol': 'tcp', 'labels': {}}
+            ]
+        }
+        self.fake_marathon.add_app(app)
+        assert_that(self.cert_store.as_dict(), succeeded(Equals({})))
+
+        self.txacme_client.issuance_error = None
+        self.fake_marathon.trigger_event(
+            'api_post_event', clientIp=None, uri='/v2/apps/my-app_1',
+            appDefinition=app)
+
+        assert_that(self.cert_store.as_dict(), succeeded(MatchesDict({
+            'example.com': Not(Is(None))
+        })))
+
     def test_sync_acme_server_failure_unacceptable(self):
         """
         When a sync is run and we try to issue a certificate for a domain but
@@ -1,17 +1,27 @@
 # -*- coding: utf-8 -*-
+import pytest
 from testtools.assertions import assert_that
 from testtools.matchers import Equals, Is
 from testtools.twistedsupport import succeeded
+from twisted.internet.defer import Deferred, fail
+from twisted.internet.task import Clock
 
 from marathon_acme.sse_protocol import SseProtocol
 
 
 class DummyTransport(object):
     disconnecting = False
+    paused = False
 
     def loseConnection(self):
         self.disconnecting = True
 
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
 
 class TestSseProtocol(object):
     def setup_method(self):
@@ -114,23 +124,93 @@ class TestSseProtocol(object):
             ('test2', 'world')
         ]))
 
-    def test_id_ignored(self):
+    def test_id(self):
         """
-        When the id field is included in an event, it should be ignored.
+        When the id field is included in an event, the event data should be
+        unaffected and the last event ID should be set once the event is
+        dispatched.
         """
         self.protocol.dataReceived(b'data:hello\r\n')
-        self.protocol.dataReceived(b'id:123\r\n\r\n')
+        self.protocol.dataReceived(b'id:123\r\n')
+
+        assert_that(self.protocol.last_event_id, Is(None))
+
+        self.protocol.dataReceived(b'\r\n')
 
         assert_that(self.messages, Equals([('message', 'hello')]))
+        assert_that(self.protocol.last_event_id, Equals('123'))
+
+    def test_id_persists_across_events(self):
+        """
+        When an event is received without an id field, the last event ID
+        should remain the ID of the previous event that had one.
+        """
+        self.protocol.dataReceived(b'id:123\r\ndata:hello\r\n\r\n')
+        self.protocol.dataReceived(b'data:world\r\n\r\n')
+
+        assert_that(self.protocol.last_event_id, Equals('123'))
+
+    def test_id_unwanted_event(self):
+        """
+        When an event that is not wanted has an ID, the last event ID should
+        still be updated.
+        """
+        self.protocol = SseProtocol(
+            lambda event, data: self.messages.append((event, data)),
+            event_types=['wanted'])
+        self.protocol.transport = self.transport
+
+        self.protocol.dataReceived(
+            b'event:unwanted\r\nid:123\r\ndata:hello\r\n\r\n')
+
+        assert_that(self.messages, Equals([]))
+        assert_that(self.protocol.last_event_id, Equals('123'))
+
+    def test_id_empty_resets(self):
+        """
+        When an event has an empty id field, the last event ID should be reset
+        to None.
+        """
+        self.protocol.dataReceived(b'id:123\r\ndata:hello\r\n\r\n')
+        self.protocol.dataReceived(b'id\r\ndata:world\r\n\r\n')
+
+        assert_that(self.protocol.last_event_id, Is(None))
+
+    def test_retry_unwanted_event(self):
+        """
+        When an event that is not wanted has a retry field, the reconnection
+        time should still be set.
+        """
+        self.protocol = SseProtocol(
+            lambda event, data: self.messages.append((event, data)),
+            event_types=['wanted'])
+        self.protocol.transport = self.transport
+
+        self.protocol.dataReceived(
+            b'event:unwanted\r\nretry:123\r\ndata:hello\r\n\r\n')
 
-    def test_retry_ignored(self):
+        assert_that(self.messages, Equals([]))
+        assert_that(self.protocol.retry, Equals(123))
+
+    def test_retry(self):
         """
-        When the retry field is included in an event, it should be ignored.
+        When the retry field is included in an event, the event data should be
+        unaffected and the reconnection time should be set.
         """
         self.protocol.dataReceived(b'data:hello\r\n')
         self.protocol.dataReceived(b'retry:123\r\n\r\n')
 
         assert_that(self.messages, Equals([('message', 'hello')]))
+        assert_that(self.protocol.retry, Equals(123))
+
+    def test_retry_not_digits_ignored(self):
+        """
+        When the retry field is included in an event but its value is not made
+        up of only digits, the field should be ignored.
+        """
+        self.protocol.dataReceived(b'retry:12.3\r\n\r\n')
+
+        assert_that(self.protocol.retry, Is(None))
 
     def test_unknown_field_ignored(self):
         """
@@ -184,6 +264,30 @@ class TestSseProtocol(object):
 
         assert_that(self.messages, Equals([('message', 'hello')]))
 
+    def test_crlf_split_across_parts(self):
+        """
+        When a '\r\n' line terminator is split across two parts of received
+        data, it should be treated as a single line terminator and not as two
+        separate lines.
+        """
+        self.protocol.dataReceived(b'data:hello\r')
+        self.protocol.dataReceived(b'\ndata:world\r')
+        self.protocol.dataReceived(b'\n\r\n')
+
+        assert_that(self.messages, Equals([('message', 'hello\nworld')]))
+
+    def test_byte_at_a_time(self):
+        """
+        When an event is received one byte at a time, the event should be
+        assembled and the handler called exactly as if the event had been
+        received all at once.
+        """
+        data = u'event:my_event\r\ndata:hëlló\r\ndata:world\r\n\r\n'
+        for byte in bytearray(data.encode('utf-8')):
+            self.protocol.dataReceived(bytes(bytearray([byte])))
+
+        assert_that(self.messages, Equals([('my_event', u'hëlló\nworld')]))
+
     def test_unicode_data(self):
         """
         When unicode data encoded as UTF-8 is received, the characters should
@@ -196,27 +300,134 @@ class TestSseProtocol(object):
     def test_line_too_long(self):
         """
         When a line is received that is beyond the maximum allowed length,
-        the transport should be in 'disconnecting' state due to a request to
-        lose the connection.
+        the event that the line is part of should be discarded and counted,
+        but the connection should be kept and later events received.
         """
-        self.protocol.MAX_LENGTH = 8  # Very long bytearrays slow down tests
+        self.protocol.MAX_LENGTH = 16  # Very long bytearrays slow down tests
         self.protocol.dataReceived(b'data:%s\r\n\r\n' % (
             b'x' * (self.protocol.MAX_LENGTH + 1),))
+        self.protocol.dataReceived(b'data:hello\r\n\r\n')
 
-        assert_that(self.transport.disconnecting, Equals(True))
+        assert_that(self.messages, Equals([('message', 'hello')]))
+        assert_that(self.protocol.discarded_events, Equals(1))
+        assert_that(self.transport.disconnecting, Equals(False))
 
     def test_incomplete_line_too_long(self):
         """
         When a part of a line is received that is beyond the maximum allowed
-        length, the transport should be in 'disconnecting' state due to a
-        request to lose the connection.
+        length, the rest of the line and the event that the line is part of
+        should be discarded, but the connection should be kept and later
+        events received.
         """
-        self.protocol.MAX_LENGTH = 8  # Very long bytearrays slow down tests
+        self.protocol.MAX_LENGTH = 16  # Very long bytearrays slow down tests
         self.protocol.dataReceived(b'data:%s' % (
             b'x' * (self.protocol.MAX_LENGTH + 1),))
+        self.protocol.dataReceived(b'x' * (self.protocol.MAX_LENGTH + 1))
+        self.protocol.dataReceived(b'x\r\ndata:more\r\n\r\n')
+        self.protocol.dataReceived(b'data:hello\r\n\r\n')
+
+        assert_that(self.messages, Equals([('message', 'hello')]))
+        assert_that(self.protocol.discarded_events, Equals(1))
+        assert_that(self.transport.disconnecting, Equals(False))
+
+    def test_incomplete_line_too_long_terminator_next(self):
+        """
+        When a part of a line is received that is beyond the maximum allowed
+        length, and the line terminator is the next thing to be received, the
+        end of the line should not be treated as the end of the event.
+        """
+        self.protocol.MAX_LENGTH = 16  # Very long bytearrays slow down tests
+        self.protocol.dataReceived(b'data:%s' % (
+            b'x' * (self.protocol.MAX_LENGTH + 1),))
+        self.protocol.dataReceived(b'\r\ndata:more\r\n\r\n')
+
+        assert_that(self.messages, Equals([]))
+        assert_that(self.protocol.discarded_events, Equals(1))
+
+    def test_event_too_long(self):
+        """
+        When an event is received with data lines that are each within the
+        maximum line length but together are beyond the maximum event length,
+        the event should be discarded and counted, but the connection should
+        be kept and later events received.
+        """
+        self.protocol.MAX_EVENT_LENGTH = 8
+        self.protocol.dataReceived(b'data:xxxx\r\n')
+        self.protocol.dataReceived(b'data:xxxx\r\n')
+        self.protocol.dataReceived(b'data:xxxx\r\n\r\n')
+        self.protocol.dataReceived(b'data:hello\r\n\r\n')
+
+        assert_that(self.messages, Equals([('message', 'hello')]))
+        assert_that(self.protocol.discarded_events, Equals(1))
+        assert_that(self.transport.disconnecting, Equals(False))
+
+    def test_unwanted_line_too_long(self):
+        """
+        When a line is received that is beyond the maximum allowed length, but
+        the line is part of an event that is not wanted, the event should be
+        dropped but not counted as discarded.
+        """
+        self.protocol = SseProtocol(
+            lambda event, data: self.messages.append((event, data)),
+            event_types=['wanted'])
+        self.protocol.transport = self.transport
+        self.protocol.MAX_LENGTH = 16  # Very long bytearrays slow down tests
+
+        self.protocol.dataReceived(b'event:unwanted\r\ndata:%s\r\n\r\n' % (
+            b'x' * (self.protocol.MAX_LENGTH + 1),))
+        self.protocol.dataReceived(b'event:wanted\r\ndata:hello\r\n\r\n')
+
+        assert_that(self.messages, Equals([('wanted', 'hello')]))
+        assert_that(self.protocol.discarded_events, Equals(0))
+
+    def test_idle_timeout(self):
+        """
+        When the protocol has an idle timeout and no data is received for
+        longer than the timeout, the connection should be closed.
+        """
+        clock = Clock()
+        self.protocol = SseProtocol(
+            lambda event, data: None, timeout=10, reactor=clock)
+        self.protocol.makeConnection(self.transport)
+
+        clock.advance(9)
+        assert_that(self.transport.disconnecting, Equals(False))
+
+        clock.advance(1)
+        assert_that(self.transport.disconnecting, Equals(True))
+
+    def test_idle_timeout_reset_by_comment(self):
+        """
+        When the protocol has an idle timeout and a comment line is received,
+        the timeout should be reset.
+        """
+        clock = Clock()
+        self.protocol = SseProtocol(
+            lambda event, data: None, timeout=10, reactor=clock)
+        self.protocol.makeConnection(self.transport)
+
+        clock.advance(9)
+        self.protocol.dataReceived(b':keepalive\r\n')
+        clock.advance(9)
+        assert_that(self.transport.disconnecting, Equals(False))
 
+        clock.advance(1)
         assert_that(self.transport.disconnecting, Equals(True))
 
+    def test_idle_timeout_cancelled_on_connection_lost(self):
+        """
+        When the protocol has an idle timeout and the connection is lost, the
+        timeout should be cancelled.
+        """
+        clock = Clock()
+        self.protocol = SseProtocol(
+            lambda event, data: None, timeout=10, reactor=clock)
+        self.protocol.makeConnection(self.transport)
+
+        self.protocol.connectionLost()
+
+        assert_that(clock.getDelayedCalls(), Equals([]))
+
     def test_transport_disconnecting(self):
         """
         When the transport for the protocol is disconnecting, processing should
@@ -263,3 +474,214 @@ class TestSseProtocol(object):
             ('status', 'hello'),
             ('message', 'world')
         ]))
+
+    def test_event_types_unwanted_dropped(self):
+        """
+        When the protocol is created with a set of event types, events of
+        other types should not be delivered to the handler.
+        """
+        self.protocol = SseProtocol(
+            lambda event, data: self.messages.append((event, data)),
+            event_types=['wanted'])
+        self.protocol.transport = self.transport
+
+        self.protocol.dataReceived(b'event:unwanted\r\ndata:hello\r\n\r\n')
+        self.protocol.dataReceived(b'data:hello\r\n\r\n')
+        self.protocol.dataReceived(b'event:wanted\r\ndata:world\r\n\r\n')
+
+        assert_that(self.messages, Equals([('wanted', 'world')]))
+
+    def test_event_types_data_before_event(self):
+        """
+        When the protocol is created with a set of event types, and the data
+        for an event is received before the event type, the event should be
+        delivered if the event type is wanted.
+        """
+        self.protocol = SseProtocol(
+            lambda event, data: self.messages.append((event, data)),
+            event_types=['wanted'])
+        self.protocol.transport = self.transport
+
+        self.protocol.dataReceived(b'data:hello\r\nevent:wanted\r\n\r\n')
+        self.protocol.dataReceived(b'data:world\r\nevent:unwanted\r\n\r\n')
+
+        assert_that(self.messages, Equals([('wanted', 'hello')]))
+
+    def test_event_types_unwanted_then_wanted(self):
+        """
+        When the protocol is created with a set of event types, and an event's
+        type is changed from an unwanted type to a wanted type before any of
+        its data is received, the event should be delivered with its data.
+        """
+        self.protocol = SseProtocol(
+            lambda event, data: self.messages.append((event, data)),
+            event_types=['wanted'])
+        self.protocol.transport = self.transport
+
+        self.protocol.dataReceived(
+            b'event:unwanted\r\nevent:wanted\r\ndata:hello\r\n\r\n')
+
+        assert_that(self.messages, Equals([('wanted', 'hello')]))
+
+    @pytest.mark.parametrize('lines', [
+        [b'data:hello', b'event:unwanted', b'event:wanted'],
+        [b'event:unwanted', b'data:hello', b'event:wanted', b'data:world'],
+    ])
+    def test_event_types_data_dropped_then_wanted(self, lines):
+        """
+        When the protocol is created with a set of event types, and an event's
+        type is changed from an unwanted type to a wanted type after some of
+        its data was dropped, the event should not be delivered with only
+        part of its data. The ``event`` field must come before the ``data``
+        fields for the event to be delivered.
+        """
+        self.protocol = SseProtocol(
+            lambda event, data: self.messages.append((event, data)),
+            event_types=['wanted'])
+        self.protocol.transport = self.transport
+
+        self.protocol.dataReceived(b'\r\n'.join(lines) + b'\r\n\r\n')
+        self.protocol.dataReceived(b'event:wanted\r\ndata:next\r\n\r\n')
+
+        assert_that(self.messages, Equals([('wanted', 'next')]))
+
+    def test_event_types_unwanted_invalid_utf8(self):
+        """
+        When the protocol is created with a set of event types, the data for
+        unwanted events should not be decoded.
+        """
+        self.protocol = SseProtocol(
+            lambda event, data: self.messages.append((event, data)),
+            event_types=['wanted'])
+        self.protocol.transport = self.transport
+
+        self.protocol.dataReceived(b'event:unwanted\r\ndata:\xff\xfe\r\n\r\n')
+        self.protocol.dataReceived(b'event:wanted\r\ndata:hello\r\n\r\n')
+
+        assert_that(self.messages, Equals([('wanted', 'hello')]))
+
+    def test_deferred_handler_serialized(self):
+        """
+        When the handler returns a Deferred, the next event should not be
+        delivered until the Deferred has fired, and the queue depth should
+        count the events that have not been handled yet.
+        """
+        deferreds = []
+
+        def handler(event, data):
+            self.messages.append((event, data))
+            d = Deferred()
+            deferreds.append(d)
+            return d
+        self.protocol = SseProtocol(handler)
+        self.protocol.transport = self.transport
+
+        self.protocol.dataReceived(b'data:hello\r\n\r\ndata:world\r\n\r\n')
+
+        assert_that(self.messages, Equals([('message', 'hello')]))
+        assert_that(self.protocol.queue_depth, Equals(2))
+
+        deferreds[0].callback(None)
+        assert_that(self.messages, Equals([
+            ('message', 'hello'), ('message', 'world')]))
+        assert_that(self.protocol.queue_depth, Equals(1))
+
+        deferreds[1].callback(None)
+        assert_that(self.protocol.queue_depth, Equals(0))
+
+    def test_queue_full_pauses_transport(self):
+        """
+        When the event queue fills up because the handler is busy, the
+        transport should be paused until the queue has drained.
+        """
+        deferreds = []
+
+        def handler(event, data):
+            d = Deferred()
+            deferreds.append(d)
+            return d
+        self.protocol = SseProtocol(handler)
+        self.protocol.MAX_PENDING_EVENTS = 2
+        self.protocol.transport = self.transport
+
+        # The first event is delivered, the next 2 are queued
+        self.protocol.dataReceived(b'data:1\r\n\r\ndata:2\r\n\r\n')
+        assert_that(self.transport.paused, Equals(False))
+        self.protocol.dataReceived(b'data:3\r\n\r\n')
+        assert_that(self.transport.paused, Equals(True))
+
+        deferreds[0].callback(None)
+        assert_that(self.transport.paused, Equals(True))
+        deferreds[1].callback(None)
+        assert_that(self.transport.paused, Equals(False))
+
+    def test_idle_timeout_stopped_while_paused(self):
+        """
+        When the transport is paused because the event queue is full, the idle
+        timeout should not close the connection. The timeout should start
+        again once the transport is resumed.
+        """
+        clock = Clock()
+        deferreds = []
+
+        def handler(event, data):
+            d = Deferred()
+            deferreds.append(d)
+            return d
+        self.protocol = SseProtocol(handler, timeout=10, reactor=clock)
+        self.protocol.MAX_PENDING_EVENTS = 1
+        self.protocol.makeConnection(self.transport)
+
+        self.protocol.dataReceived(b'data:1\r\n\r\ndata:2\r\n\r\n')
+        assert_that(self.transport.paused, Equals(True))
+        clock.advance(20)
+        assert_that(self.transport.disconnecting, Equals(False))
+
+        deferreds[0].callback(None)
+        deferreds[1].callback(None)
+        assert_that(self.transport.paused, Equals(False))
+        clock.advance(9)
+        assert_that(self.transport.disconnecting, Equals(False))
+        clock.advance(1)
+        assert_that(self.transport.disconnecting, Equals(True))
+
+    def test_connection_lost_waits_for_queue(self):
+        """
+        When the connection is lost while events are still queued, the
+        finished deferred should only fire once the events have been handled.
+        """
+        deferreds = []
+
+        def handler(event, data):
+            d = Deferred()
+            deferreds.append(d)
+            return d
+        self.protocol = SseProtocol(handler)
+        self.protocol.transport = self.transport
+        finished = self.protocol.when_finished()
+
+        self.protocol.dataReceived(b'data:1\r\n\r\ndata:2\r\n\r\n')
+        self.protocol.connectionLost()
+        assert_that(finished.called, Equals(False))
+
+        deferreds[0].callback(None)
+        assert_that(finished.called, Equals(False))
+        deferreds[1].callback(None)
+        assert_that(finished, succeeded(Is(None)))
+
+    def test_handler_failure(self):
+        """
+        When the handler fails to handle an event, the failure should be
+        logged and following events should still be delivered.
+        """
+        def handler(event, data):
+            self.messages.append((event, data))
+            return fail(RuntimeError('boom'))
+        self.protocol = SseProtocol(handler)
+        self.protocol.transport = self.transport
+
+        self.protocol.dataReceived(b'data:hello\r\n\r\ndata:world\r\n\r\n')
+
+        assert_that(self.messages, Equals([
+            ('message', 'hello'), ('message', 'world')]))
+        assert_that(self.protocol.queue_depth, Equals(0))
@@ -46,6 +46,10 @@ setup(
     long_description=readme(),
     packages=find_packages(),
     install_requires=install_requires,
+    extras_require={
+        # Faster JSON encoding and decoding, used if installed
+        'orjson': ['orjson; python_version >= "3.6"'],
+    },
     classifiers=[
         'Development Status :: 3 - Alpha',
         'Framework :: Twisted',